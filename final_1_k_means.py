@@ -6,120 +6,577 @@ Automatically generated by Colab.
 Original file is located at
     https://colab.research.google.com/drive/1kx-8jFfdJDHk1FTfOgrvNt6Js5rtV3QP
 
+Usage (see main):
+    python final_1_k_means.py clean --techs cSi --start 2022 --end 2022-03-31
+    python final_1_k_means.py search-space --nb-vals 10
+    python final_1_k_means.py evaluate --workers 4 --save-dir results
+    python final_1_k_means.py --memory-budget 512 evaluate --nb-vals 15 --save-dir results
+    python final_1_k_means.py report --results-dir results
+The functions can also be imported (import final_1_k_means), plotting and optional packages are imported when used
+
 ### data_cleaning
 """
 
+import os
+import sys
 import pandas as pd
 import numpy as np
-from scipy.ndimage import gaussian_filter1d
-import matplotlib.pyplot as plt
-
-# Read data files
-pv_data = pd.read_csv('https://gitlab.in2p3.fr/energy4climate/public/sirta-pv1-data/-/raw/master/pv_data/2022/FranceWatts_20220101@08h01m12s_20220405@12h59m32s.csv?ref_type=heads')
-
-pv_data = pv_data[['Date', 'Pmpp', 'Vmpp', 'Impp', 'Tmod']]
-pv_data['Date'] = pd.to_datetime(pv_data['Date'])
-pv_data = pv_data.set_index('Date')
+from scipy.ndimage import gaussian_filter1d, binary_dilation
+import json
+import time
+import hashlib
+import shutil
+import tempfile
+import asyncio
+import argparse
+import platform
+import importlib.metadata
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import pvlib
+from pvlib import ivtools, pvsystem
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
 
-meteo_data = pd.read_csv('https://gitlab.in2p3.fr/energy4climate/public/sirta-pv1-data/-/raw/master/meteo_data/2022/meteo_20220101@07h50m20s_20220406@14h21m10s.csv?ref_type=heads')
+# Opt-in instrumentation of the pipeline stages: wall time, CPU time, memory (RSS at start and end, peak RSS of the stage)
+# and counts written as JSON lines
+# Disabled (no-op) until enable_metrics is called; forked worker processes append to the same file
+metrics = {'path': None, 'profile': None, 'profiler': 'cProfile', 'profilers': {}, 'stages': []}
 
-meteo_data = meteo_data[['Date', 'GPOA_pyrano']]
-meteo_data.columns = ['Date', 'GPOA']
-meteo_data['Date'] = pd.to_datetime(meteo_data['Date'])
-meteo_data = meteo_data.set_index('Date')
+def enable_metrics(path='results/metrics.jsonl', profile=None, profiler='cProfile'):
+    ''' Inputs:
+    path: JSON-lines file of the records (appended)
+    profile: name of the stage to profile (e.g. 'search_space', 'likelihood'), None to disable
+    profiler: 'cProfile' (stats saved to {path}.{stage}.{pid}.prof) or 'pyinstrument' (report saved to {path}.{stage}.{pid}.txt) '''
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    metrics.update(path=path, profile=profile, profiler=profiler, profilers={}, stages=[])
+
+def disable_metrics():
+    metrics.update(path=None, profile=None, profilers={})
+
+def _proc_memory_mb():
+    # Current and peak resident set size of the process (VmRSS, VmHWM) from /proc, None if not available
+    try:
+        with open('/proc/self/status') as f:
+            values = {line.split(':')[0]: int(line.split()[1])/1024 for line in f if line.startswith(('VmRSS', 'VmHWM'))}
+        return values['VmRSS'], values['VmHWM']
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _reset_peak_rss():
+    # Reset the peak resident set size (VmHWM) of the process to its current RSS (Linux), False if not possible
+    if metrics.get('rss_reset') is False:
+        return False
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        metrics['rss_reset'] = True
+    except OSError:
+        metrics['rss_reset'] = False
+    return metrics['rss_reset']
+
+def _process_peak_rss_mb():
+    # Peak resident set size of the whole process and of its terminated children since they started
+    # (ru_maxrss is in KB on Linux, bytes on macOS)
+    if resource is None:
+        return None, None
+    unit = 1024**2 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/unit, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/unit)
+
+def _memory_start():
+    # Memory at the start of a stage: the peak of the enclosing stages so far is kept before the peak is reset
+    memory = _proc_memory_mb()
+    if memory is None:
+        return None
+    for outer in metrics['stages']:
+        outer['peak'] = max(outer['peak'], memory[1])
+    if not _reset_peak_rss():
+        return None
+    current = {'start': memory[0], 'peak': memory[0]}
+    metrics['stages'].append(current)
+    return current
+
+def _memory_fields(current):
+    # Memory fields of a stage record: RSS at the start and end and peak RSS of the stage itself when the peak can be reset,
+    # otherwise the peak RSS of the whole process since it started (named as such)
+    if current is None:
+        peak, peak_children = _process_peak_rss_mb()
+        return {'process_peak_rss_mb': peak, 'process_peak_rss_children_mb': peak_children}
+    metrics['stages'] = [outer for outer in metrics['stages'] if outer is not current]
+    rss, peak = _proc_memory_mb()
+    return {'rss_start_mb': current['start'], 'rss_end_mb': rss, 'peak_rss_mb': max(current['peak'], peak)}
+
+def log_metrics(stage_name, **fields):
+    # Append one record to the metrics file (no-op when the instrumentation is disabled)
+    if metrics['path'] is None:
+        return
+    record = dict(stage=stage_name, pid=os.getpid(), time=time.time(), **fields)
+    with open(metrics['path'], 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+def _profiler(stage_name, start=True):
+    # Profiler of the stage, accumulated over all its runs in the process and saved after each run
+    path = f"{metrics['path']}.{stage_name}.{os.getpid()}"
+    profiler = metrics['profilers'].get(stage_name)
+    if metrics['profiler'] == 'pyinstrument':
+        if profiler is None:
+            from pyinstrument import Profiler
+            profiler = metrics['profilers'][stage_name] = Profiler()
+        if start:
+            profiler.start()
+        else:
+            profiler.stop()
+            with open(path + '.txt', 'w') as f:
+                f.write(profiler.output_text())
+    else:
+        if profiler is None:
+            import cProfile
+            profiler = metrics['profilers'][stage_name] = cProfile.Profile()
+        if start:
+            profiler.enable()
+        else:
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+
+@contextmanager
+def stage(stage_name, **fields):
+    ''' Measure a block of code: with stage('search_space') as counts: ... counts['grid'] = len(bpe)
+    The yielded dictionary holds the fields (counts, day...) written with the measures '''
+
+    if metrics['path'] is None:
+        yield fields
+        return
+
+    profile = metrics['profile'] == stage_name
+    if profile:
+        _profiler(stage_name)
+    memory = _memory_start()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield fields
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if profile:
+            _profiler(stage_name, start=False)
+        log_metrics(stage_name, wall_s=wall, cpu_s=cpu, **_memory_fields(memory), **fields)
+
+def metrics_summary(path=None):
+    ''' Aggregate the records of the metrics file per stage, print it and append it to the file
+    Output: DataFrame of the number of records, total wall and CPU times, maximum of the memory fields and sums of the counts per stage '''
+
+    path = path or metrics['path']
+    records = pd.read_json(path, lines=True)
+    records = records[records['stage'] != 'summary']
+
+    numeric = records.drop(columns=['pid', 'time']).select_dtypes('number')
+    rss = [col for col in numeric.columns if 'rss' in col]
+    summary = numeric.groupby(records['stage']).agg({col: 'max' if col in rss else 'sum' for col in numeric.columns})
+    summary.insert(0, 'records', records.groupby('stage').size())
+    print(summary)
+
+    with open(path, 'a') as f:
+        f.write(json.dumps({'stage': 'summary', 'time': time.time(), 'stages': summary.to_dict('index')}, default=float) + '\n')
+
+    return summary
+
+# Read data files by chunks: only the needed columns, float32 values, fixed-format dates
+def read_csv_chunked(path, columns, rename=None, start=None, end=None, lower_bounds=None, chunksize=500_000, dtype=np.float32, date_format='ISO8601'):
+    ''' Inputs:
+    path: path or URL of the CSV file (with a 'Date' column)
+    columns: measured columns to read
+    rename: new names of the columns (dictionary)
+    start, end: date range to keep (inclusive, same as data.loc[start:end])
+    lower_bounds: keep rows strictly above these values (dictionary, new column names)
+    chunksize: number of rows read at once (bounds the peak memory)
+    Output: DataFrame indexed by Date '''
+
+    start = pd.Period(start).start_time if start is not None else pd.Timestamp.min
+    end = pd.Period(end).end_time if end is not None else pd.Timestamp.max
+
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=['Date'] + columns, dtype={col: dtype for col in columns}, chunksize=chunksize):
+        dates = pd.to_datetime(chunk['Date'], format=date_format)
+        chunk = chunk[columns].set_index(pd.DatetimeIndex(dates, name='Date')).rename(columns=rename or {})
+
+        keep = (chunk.index >= start) & (chunk.index <= end)
+        for col, bound in (lower_bounds or {}).items():
+            keep &= (chunk[col] > bound).to_numpy()
+        chunks.append(chunk[keep])
+
+        if len(dates) and dates.iloc[0] > end: #files are logged chronologically: the rest is after the date range
+            break
+
+    if not chunks:
+        return pd.DataFrame(columns=[(rename or {}).get(col, col) for col in columns], index=pd.DatetimeIndex([], name='Date'))
+    return pd.concat(chunks)
+
+# Local columnar store of the cleaned data, partitioned by technology and month (Parquet)
+data_store_dir = 'data_store'
+mirror_dir = None #local directory with a copy of the source files (used instead of the URLs when set)
+
+def source_path(url, mirror_dir=None):
+    # Local copy of a source file if available in the mirror directory, otherwise the URL itself
+    if mirror_dir is not None:
+        path = os.path.join(mirror_dir, os.path.basename(url.split('?')[0]))
+        if os.path.exists(path):
+            return path
+    return url
+
+def write_data_store(data, pv_tech, store_dir=None):
+    ''' Inputs:
+    data: cleaned DataFrame indexed by Date
+    pv_tech: technology (key of modules)
+    store_dir: directory of the store (default: data_store_dir)
+    The days present in data are replaced, the other days of their months and the other partitions are kept '''
+
+    # A partition is written as a whole: the stored rows of the other days of the same months are written back
+    path = store_dir or data_store_dir
+    months = sorted(set(data.index.strftime('%Y-%m')))
+    if months and os.path.exists(os.path.join(path, f'pv_tech={pv_tech}')):
+        stored = read_data_store(pv_tech, months[0], months[-1], store_dir=path)
+        days = data.index.normalize().unique()
+        stored = stored[stored.index.strftime('%Y-%m').isin(months) & ~stored.index.normalize().isin(days)]
+        if len(stored):
+            data = pd.concat([stored, data]).sort_index(kind='stable')
+
+    store = data.reset_index()
+    store['pv_tech'] = pv_tech
+    store['month'] = store['Date'].dt.strftime('%Y-%m')
+    store.to_parquet(path, partition_cols=['pv_tech', 'month'], index=False,
+                     existing_data_behavior='delete_matching')
+
+def read_data_store(pv_tech, start=None, end=None, columns=None, store_dir=None):
+    ''' Inputs:
+    pv_tech: technology (key of modules)
+    start, end: date range (inclusive, same as data.loc[start:end]), only the matching partitions are read
+    columns: columns to read (default: all)
+    Output: DataFrame indexed by Date '''
+
+    filters = [('pv_tech', '==', pv_tech)]
+    if start is not None:
+        start = pd.Period(start).start_time
+        filters += [('month', '>=', start.strftime('%Y-%m')), ('Date', '>=', start)]
+    if end is not None:
+        end = pd.Period(end).end_time
+        filters += [('month', '<=', end.strftime('%Y-%m')), ('Date', '<=', end)]
+
+    data = pd.read_parquet(store_dir or data_store_dir, columns=None if columns is None else ['Date'] + columns, filters=filters)
+    data = data.drop(columns=['pv_tech', 'month'], errors='ignore').set_index('Date').sort_index()
 
-pv_data, meteo_data = pv_data.loc['2022':'2022-03-31'], meteo_data.loc['2022':'2022-03-31']
+    return data
 
-# Minimum Intensity Threshold (MIT)
-meteo_data = meteo_data[meteo_data['GPOA'] > 100]
+pv_url = 'https://gitlab.in2p3.fr/energy4climate/public/sirta-pv1-data/-/raw/master/pv_data/2022/FranceWatts_20220101@08h01m12s_20220405@12h59m32s.csv?ref_type=heads'
+meteo_url = 'https://gitlab.in2p3.fr/energy4climate/public/sirta-pv1-data/-/raw/master/meteo_data/2022/meteo_20220101@07h50m20s_20220406@14h21m10s.csv?ref_type=heads'
 
-# Keep positive values only
-non_neg_cols = ['Impp', 'Vmpp', 'Pmpp']
-for non_neg_col in non_neg_cols:
-    pv_data = pv_data[pv_data[non_neg_col] > 0]
+# Source files of the PV data of each technology (keys of modules), all measured with the same meteo sensors
+pv_urls = {'cSi': pv_url}
 
-# Resample to closest 5s (meteo data is measured every 5s, pv data every 30s)
-pv_data = pv_data.resample('5s').mean().dropna()
-meteo_data = meteo_data.resample('5s').mean().dropna()
+def pv_source_paths(pv_techs, mirror_dir=None):
+    # Source files of the PV data of the technologies (see source_path), error for the technologies without data
+    missing = [pv_tech for pv_tech in pv_techs if pv_tech not in pv_urls]
+    if missing:
+        raise ValueError(f'No PV data source for {missing}, technologies with data: {list(pv_urls)}')
+    return {pv_tech: source_path(pv_urls[pv_tech], mirror_dir) for pv_tech in pv_techs}
 
 # Filter outliers using Gaussian 1D filter
 def filter_outliers(data, sigma=5, out_thresh=0.05): #out_thresh: max error accepted (threshold to determine if a point is considered an outlier or not)
-    days = sorted(set(data.index.strftime('%Y-%m-%d')))
-
-    data_gauss = pd.DataFrame(index=data.index, columns=[col + '_gauss' for col in data.columns])
+    with stage('filter_outliers', rows=len(data)) as counts:
+        values = data.to_numpy(dtype=np.float64)
 
-    for col in data.columns:
-        for day in days: #apply filter on a daily basis to avoid influence from previous and future days
-            data_gauss[col + '_gauss'].loc[day] = gaussian_filter1d(data[col].loc[day], sigma=sigma) #sigma=5 empirical value
+        # Group rows by calendar day once (stable sort keeps the order of the rows within each day)
+        day_codes = data.index.floor('D').asi8
+        order = np.argsort(day_codes, kind='stable')
+        bounds = np.flatnonzero(np.diff(day_codes[order])) + 1
 
-        data_gauss[col + '_mape'] = np.abs(data_gauss[col + '_gauss'] - data[col]) / (data[col] + 1E-8) #percentage error between filtered and original data
+        data_gauss = np.empty_like(values)
+        for rows in np.split(order, bounds): #apply filter on a daily basis to avoid influence from previous and future days
+            data_gauss[rows] = gaussian_filter1d(values[rows], sigma=sigma, axis=0) #sigma=5 empirical value
 
-    mape_cols = [col + '_mape' for col in data.columns]
-    data_gauss = data_gauss[(data_gauss[mape_cols] <= out_thresh).all(axis=1)] #remove data rows with outliers in any of the measured variables
+        mape = np.abs(data_gauss - values) / (values + 1E-8) #percentage error between filtered and original data
 
-    data = data.loc[data_gauss.index] #keep data points with no outliers
+        data = data[(mape <= out_thresh).all(axis=1)] #keep data points with no outliers in any of the measured variables
+        counts['kept'] = len(data)
 
     return data
 
-pv_data, meteo_data = filter_outliers(pv_data, sigma=5), filter_outliers(meteo_data, sigma=5)
-
-# Merge PV and Meteo data
-data = pd.concat([pv_data, meteo_data], axis=1).dropna()
-
-# Automatic detection of outliers
-fig, ax = plt.subplots(constrained_layout=True)
-ratio = data['Impp']/data['GPOA']
-out_high = data[(data['Impp']/data['GPOA']) > (ratio.mean()+2*ratio.std())]
-out_low = data[(data['Impp']/data['GPOA']) < (ratio.mean()-2*ratio.std())]
-ax.scatter(data['GPOA'], data['Impp'])
-ax.scatter(out_high['GPOA'], out_high['Impp'], c='red')
-ax.scatter(out_low['GPOA'], out_low['Impp'], c='green')
-ax.plot([0, 1000, 1000*1.4], [0, ratio.mean()*1000, ratio.mean()*1400], '--', c='black')
-ax.set_xlabel('GPOA Irradiance [W/m$^2$]')
-ax.set_ylabel('I$_{mpp}$ [A]')
-fig.suptitle('Automatic Detection of Outliers Outside 2*\u03C3 Region \n (Red & Green Points)')
-
-data = data.drop(out_high.index)
-
-data = data.drop(out_low.index)
-
-# Plot Impp vs Irradiance
-fig, ax = plt.subplots(constrained_layout=True)
-sc = ax.scatter(data['GPOA'], data['Impp'], c=data.index)
-cbar = plt.colorbar(sc)
-cbar.ax.set_yticklabels(pd.to_datetime(cbar.get_ticks()).strftime(date_format='%Y-%m-%d'))
-ax.plot([0, 1000, 1000*1.4], [0, ratio.mean()*1000, ratio.mean()*1400], '--', c='black')
-ax.set_xlabel('GPOA Irradiance [W/m$^2$]')
-ax.set_ylabel('I$_{mpp}$ [A]')
-
-# Check daily profiles
-fig, ax = plt.subplots(constrained_layout=True)
-ax.plot(data['Impp'], label='I$_{MPP}$')
-ax.set_ylabel('I$_{MPP}$ [A]')
-ax2 = ax.twinx()
-ax2.plot(data['GPOA'], c='orange', label='GPOA')
-ax2.set_ylabel('GPOA Irradiance [W/m$^2$]')
-fig.legend()
-
-fig, ax = plt.subplots(constrained_layout=True)
-ax.plot(data['Vmpp'], label='V$_{MPP}$')
-ax.set_ylabel('V$_{MPP}$ [V]')
-ax2 = ax.twinx()
-ax2.plot(data['GPOA'], c='orange', label='GPOA')
-ax2.set_ylabel('GPOA Irradiance [W/m$^2$]')
-fig.legend()
-
-"""###Utils"""
-
-pip install pvlib
+# Automatic detection of outliers outside the 2*sigma region of Impp/GPOA
+# Statistics of each day (count, mean, M2 = sum of squared deviations) combined over a window of days: a global sigma
+# over months flags the degradation itself as outliers
+def ratio_day_stats(data):
+    # Count, mean and M2 of Impp/GPOA of each day of data (DataFrame indexed by day)
+    ratio = (data['Impp']/data['GPOA']).to_numpy().astype(np.float64)
+    valid = ~np.isnan(ratio)
+    days, day_idx = np.unique(data.index.values.astype('datetime64[D]')[valid], return_inverse=True)
+    n = np.bincount(day_idx, minlength=len(days))
+    mean = np.bincount(day_idx, weights=ratio[valid], minlength=len(days)) / np.maximum(n, 1)
+    m2 = np.bincount(day_idx, weights=(ratio[valid] - mean[day_idx])**2, minlength=len(days))
+    return pd.DataFrame({'n': n, 'mean': mean, 'm2': m2}, index=pd.DatetimeIndex(days, name='Date'))
+
+def combine_stats(n, mean, m2):
+    # Count, mean and M2 of the union of groups from the statistics of each group (Chan's parallel formula)
+    total = n.sum()
+    combined_mean = (n*mean).sum() / max(total, 1)
+    return total, combined_mean, (m2 + n*(mean - combined_mean)**2).sum()
+
+def ratio_bounds(data, window_days=None, n_sigma=2, state=None):
+    ''' Region of n_sigma standard deviations of Impp/GPOA around the mean
+    Inputs:
+    data: merged PV and meteo data
+    window_days: statistics of the window_days days ending on the day of each row (1: each day on its own), None for all the days
+    state: dictionary of the statistics of the previous days (updated with the days of data, which replace the saved ones),
+    so that only the new days are processed as they arrive
+    Output: arrays of Impp/GPOA, lower and upper bounds of each row '''
+
+    stats = ratio_day_stats(data)
+    if state is not None:
+        if 'stats' in state:
+            stats = pd.concat([state['stats'][~state['stats'].index.isin(stats.index)], stats]).sort_index()
+        state['stats'] = stats
+
+    if window_days is None:
+        window_stats = np.array([combine_stats(*stats[['n', 'mean', 'm2']].to_numpy().T)])
+        row_day = np.zeros(len(data), dtype=np.int64)
+    else:
+        days, row_day = np.unique(data.index.values.astype('datetime64[D]'), return_inverse=True)
+        window_stats = np.array([combine_stats(*stats.loc[day - pd.Timedelta(days=window_days - 1):day, ['n', 'mean', 'm2']].to_numpy().T)
+                                 for day in pd.DatetimeIndex(days)]).reshape(-1, 3)
+
+    n, mean, m2 = window_stats.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(m2 / (n - 1)) #same as pandas std (ddof=1)
+
+    ratio = (data['Impp']/data['GPOA']).to_numpy()
+    return ratio, (mean - n_sigma*std)[row_day], (mean + n_sigma*std)[row_day]
+
+def ratio_mask(data, window_days=None, n_sigma=2, state=None):
+    # Boolean mask of the rows inside the n_sigma region of Impp/GPOA (see ratio_bounds)
+    ratio, low, high = ratio_bounds(data, window_days, n_sigma, state)
+    return ~((ratio > high) | (ratio < low))
+
+def slot_means(data, freq='5s'):
+    # Mean of the records of each time slot, only for the slots having records (same rows as resample(freq).mean().dropna()
+    # without the dense index over the whole period, nights and MIT gaps included)
+    slots = data.index.floor(freq)
+    if slots.is_unique and (slots == data.index).all(): #already one record per slot
+        return data.dropna()
+    return data.groupby(slots).mean().dropna().rename_axis(data.index.name)
+
+def align(pv, meteo, tolerance='0s', window=None):
+    ''' Join each PV sample to the meteo data (both with a sorted index)
+    Inputs:
+    tolerance: nearest meteo sample within this time difference ('0s': same time only, as pd.concat([pv, meteo], axis=1).dropna())
+    window: mean of the meteo samples within +/- window/2 of each PV sample instead of the nearest one (e.g. '30s'), None to skip
+    Output: PV data with the meteo columns, PV samples without meteo data are dropped '''
+
+    if window is None:
+        merged = pd.merge_asof(pv, meteo, left_index=True, right_index=True, direction='nearest', tolerance=pd.Timedelta(tolerance))
+        return merged.dropna(subset=list(meteo.columns))
+
+    # Window averages with cumulative sums: no intermediate index
+    half = pd.Timedelta(window).value // 2
+    t, t_meteo = pv.index.asi8, meteo.index.asi8
+    lo, hi = np.searchsorted(t_meteo, t - half, side='left'), np.searchsorted(t_meteo, t + half, side='right')
+    sums = np.vstack([np.zeros(meteo.shape[1]), np.cumsum(meteo.to_numpy(dtype=np.float64), axis=0)])
+    found = hi > lo
+    means = (sums[hi[found]] - sums[lo[found]]) / (hi - lo)[found, np.newaxis]
+    merged = pv[found].copy()
+    merged[list(meteo.columns)] = means.astype(meteo.dtypes.iloc[0])
+
+    return merged
+
+def ingest_fleet(pv_sources, meteo_source, start=None, end=None, store_dir=None, plot_dir=None, tolerance='0s', window=None,
+                 ratio_window=None, n_sigma=2):
+    ''' Inputs:
+    pv_sources: dictionary {pv_tech: path or URL of the PV data file}
+    meteo_source: path or URL of the meteo data file, read and cleaned once for all the technologies
+    start, end: period to keep
+    store_dir: data store directory (see write_data_store)
+    plot_dir: directory where the outliers and the cleaned data of each technology are plotted (see plot_outliers, plot_data), None to skip
+    tolerance, window: alignment of the PV samples with the meteo data (see align)
+    ratio_window, n_sigma: outliers of Impp/GPOA (see ratio_bounds), with a window the statistics of the previous days are
+    kept in the store (_ratio_stats_{pv_tech}.csv) so that new days can be ingested on their own
+    Output: dictionary {pv_tech: cleaned data}, each one also written to the data store '''
+
+    # Minimum Intensity Threshold (MIT)
+    with stage('ingest', source='meteo') as counts:
+        meteo = read_csv_chunked(meteo_source, ['GPOA_pyrano'], rename={'GPOA_pyrano': 'GPOA'}, start=start, end=end,
+                                 lower_bounds={'GPOA': 100})
+        counts['rows'] = len(meteo)
+
+    # Average to closest 5s (meteo data is measured every 5s, pv data every 30s)
+    with stage('resample'):
+        meteo = slot_means(meteo, '5s')
+    meteo = filter_outliers(meteo, sigma=5)
+
+    fleet_data = {}
+    for pv_tech, pv_source in pv_sources.items():
+        # Keep positive values only
+        with stage('ingest', source='pv', pv_tech=pv_tech) as counts:
+            pv = read_csv_chunked(pv_source, ['Pmpp', 'Vmpp', 'Impp', 'Tmod'], start=start, end=end,
+                                  lower_bounds={'Impp': 0, 'Vmpp': 0, 'Pmpp': 0})
+            counts['rows'] = len(pv)
+        with stage('resample', pv_tech=pv_tech):
+            pv = slot_means(pv, '5s')
+        pv = filter_outliers(pv, sigma=5)
+
+        # Merge with the shared meteo data
+        with stage('align', pv_tech=pv_tech, rows=len(pv)) as counts:
+            merged = align(pv, meteo, tolerance, window)
+            counts['kept'] = len(merged)
+
+        # Automatic detection of outliers outside the 2*sigma region of Impp/GPOA
+        with stage('pruning_2sigma', pv_tech=pv_tech, rows=len(merged)) as counts:
+            state_path = os.path.join(store_dir or data_store_dir, f'_ratio_stats_{pv_tech}.csv')
+            state = None
+            if ratio_window is not None:
+                state = {'stats': pd.read_csv(state_path, index_col=0, parse_dates=True)} if os.path.exists(state_path) else {}
+            ratio, low, high = ratio_bounds(merged, ratio_window, n_sigma, state)
+            keep = ~((ratio > high) | (ratio < low))
+            tech_data = merged[keep]
+            counts['removed'] = len(merged) - len(tech_data)
+        if plot_dir is not None:
+            render_figures({f'outliers_{pv_tech}': (plot_outliers, (merged, merged[ratio > high], merged[ratio < low]), {}),
+                            f'data_{pv_tech}': (plot_data, (tech_data,), {'ratio_mean': np.nanmean(ratio)})}, plot_dir)
+
+        with stage('write', output='data_store', pv_tech=pv_tech):
+            write_data_store(tech_data, pv_tech, store_dir)
+            if state is not None:
+                state['stats'].to_csv(state_path)
+        fleet_data[pv_tech] = tech_data
+
+    return fleet_data
+
+# Dense data is reduced before drawing so that the rendering cost depends on the pixels, not on the number of samples
+def density_grid(x, y, c=None, bins=(300, 200)):
+    ''' 2-D binning of a scatter plot
+    Inputs:
+    x, y: coordinates of the points
+    c: values to average in each bin (e.g. dates), None to count only
+    bins: number of bins or bin edges in x and y (see np.histogram2d)
+    Output: x edges, y edges, counts per bin (NaN when empty), mean of c per bin (None if c is None) '''
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins)
+    c_mean = None
+    if c is not None:
+        sums = np.histogram2d(x, y, bins=[x_edges, y_edges], weights=np.asarray(c, dtype=np.float64))[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            c_mean = sums / counts
+    counts[counts == 0] = np.nan
+
+    return x_edges, y_edges, counts, c_mean
+
+def envelope(series, width=2000):
+    ''' Min/max decimation of a time series (sorted index): each of the width time bins is reduced to its min and max
+    Output: times, values (at most 2*width points, the line drawn looks the same as the full resolution one) '''
+
+    if len(series) <= 2*width:
+        return series.index, series.to_numpy()
+
+    t = series.index.asi8
+    values = series.to_numpy(dtype=np.float64)
+    starts = np.unique(np.searchsorted(t, np.linspace(t[0], t[-1], width + 1)[:-1])) #first sample of each non-empty bin
+    lo, hi = np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)
+
+    return pd.to_datetime(np.repeat(t[starts], 2)).tz_localize(series.index.tz), np.column_stack([lo, hi]).ravel()
+
+def plot_outliers(data, out_high, out_low):
+    # Impp vs irradiance with the points outside the 2*sigma region (data before pruning)
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LogNorm
+
+    fig, ax = plt.subplots(constrained_layout=True)
+    ratio = data['Impp']/data['GPOA']
+    # Density of the dense layer only (outliers excluded), the sparse outliers drawn as points on top
+    inliers = data[~data.index.isin(out_high.index.union(out_low.index))]
+    if len(inliers):
+        x_edges, y_edges, counts, _ = density_grid(inliers['GPOA'], inliers['Impp'])
+        ax.pcolormesh(x_edges, y_edges, counts.T, cmap='Blues', norm=LogNorm(), rasterized=True)
+    ax.scatter(out_high['GPOA'], out_high['Impp'], c='red', s=4, rasterized=True)
+    ax.scatter(out_low['GPOA'], out_low['Impp'], c='green', s=4, rasterized=True)
+    ax.plot([0, 1000, 1000*1.4], [0, ratio.mean()*1000, ratio.mean()*1400], '--', c='black')
+    ax.set_xlabel('GPOA Irradiance [W/m$^2$]')
+    ax.set_ylabel('I$_{mpp}$ [A]')
+    fig.suptitle('Automatic Detection of Outliers Outside 2*σ Region \n (Red & Green Points)')
+
+    return fig
+
+def plot_data(data, ratio_mean=None):
+    # Impp vs irradiance coloured by date and daily profiles of the cleaned data
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    if ratio_mean is None:
+        ratio_mean = (data['Impp']/data['GPOA']).mean()
+    figs = []
+
+    # Plot Impp vs Irradiance (mean date of the points of each bin)
+    fig, ax = plt.subplots(constrained_layout=True)
+    x_edges, y_edges, _, dates = density_grid(data['GPOA'], data['Impp'], c=mdates.date2num(data.index))
+    mesh = ax.pcolormesh(x_edges, y_edges, dates.T, rasterized=True)
+    cbar = plt.colorbar(mesh)
+    cbar.ax.yaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    ax.plot([0, 1000, 1000*1.4], [0, ratio_mean*1000, ratio_mean*1400], '--', c='black')
+    ax.set_xlabel('GPOA Irradiance [W/m$^2$]')
+    ax.set_ylabel('I$_{mpp}$ [A]')
+    figs.append(fig)
+
+    # Check daily profiles
+    for col, label, unit in [('Impp', 'I$_{MPP}$', 'A'), ('Vmpp', 'V$_{MPP}$', 'V')]:
+        fig, ax = plt.subplots(constrained_layout=True)
+        ax.plot(*envelope(data[col]), label=label)
+        ax.set_ylabel(f'{label} [{unit}]')
+        ax2 = ax.twinx()
+        ax2.plot(*envelope(data['GPOA']), c='orange', label='GPOA')
+        ax2.set_ylabel('GPOA Irradiance [W/m$^2$]')
+        fig.legend()
+        figs.append(fig)
+
+    return figs
+
+def _render(name, func, args, kwargs, results_dir, formats, dpi, headless):
+    # Draw the figure(s) of one task and save them, Agg backend in the worker processes
+    import matplotlib
+    if headless or 'matplotlib.pyplot' not in sys.modules:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figs = func(*args, **kwargs)
+    figs = figs if isinstance(figs, list) else [figs]
+    paths = []
+    for i, fig in enumerate(figs):
+        suffix = '' if len(figs) == 1 else f'_{i}'
+        for fmt in formats:
+            paths.append(os.path.join(results_dir, f'{name}{suffix}.{fmt}'))
+            fig.savefig(paths[-1], dpi=dpi)
+        plt.close(fig)
+
+    return paths
+
+def render_figures(tasks, results_dir='results', formats=('png',), dpi=100, workers=1):
+    ''' Inputs:
+    tasks: dictionary {name: (plot function, args, kwargs)}, the function returns a figure or a list of figures
+    results_dir: output directory, the files are named {name}.{format} ({name}_{i}.{format} for a list of figures)
+    formats: file formats (e.g. ('png', 'svg')), the dense layers are rasterized in the vector formats
+    workers: number of processes, the figures are independent
+    Output: list of the saved files '''
+
+    os.makedirs(results_dir, exist_ok=True)
+    with stage('render', figures=len(tasks), workers=workers):
+        if workers == 1 or len(tasks) < 2:
+            paths = [_render(name, *task, results_dir, formats, dpi, False) for name, task in tasks.items()]
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+                futures = [pool.submit(_render, name, *task, results_dir, formats, dpi, True) for name, task in tasks.items()]
+                paths = [future.result() for future in futures]
 
-import pvlib
-from pvlib import iotools, location
+    return [path for task_paths in paths for path in task_paths]
 
-from pvlib import ivtools, pvsystem
-import itertools
-from sklearn.metrics import mean_absolute_percentage_error as mape
-from sklearn.metrics import mean_squared_error as mse
+"""###Utils"""
 
 modules = {'cSi': {'Name': 'FranceWatts',
                     'celltype': 'monoSi',
@@ -151,29 +608,144 @@ modules = {'cSi': {'Name': 'FranceWatts',
               'cells_in_series': 154 / 2, 'temp_ref': 25, 'power_tolerance': 5},
            }
 
-def search_space(data, module, nb_vals=[5]*5, freq=0.5, meas_unc=7.2):
+# Cache of the reference SDM parameters fitted from the datasheet specs (fit_cec_sam through PySAM)
+sdm_fields = ['V_mp_ref', 'I_mp_ref', 'V_oc_ref', 'I_sc_ref', 'alpha_sc', 'beta_oc', 'gamma_pmp', 'cells_in_series', 'temp_ref', 'celltype']
+sdm_cache_dir = 'sdm_cache'
+_sdm_memo = {}
+sdm_cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+
+def sdm_key(module):
+    # Content hash of the datasheet fields used by the fit
+    specs = json.dumps({field: module[field] for field in sdm_fields}, sort_keys=True)
+    return hashlib.sha256(specs.encode()).hexdigest()[:16]
+
+def fit_sdm(module, cache_dir=None):
+    ''' Inputs:
+    module: module specs (dictionary)
+    cache_dir: directory of the on-disk cache (default: sdm_cache_dir)
+    Output: IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, Adjust
+    Same as ivtools.sdm.fit_cec_sam, memoized in-process and on disk by a hash of the datasheet fields '''
+
+    cache_dir = cache_dir or sdm_cache_dir
+    key = sdm_key(module)
+
+    if key in _sdm_memo:
+        sdm_cache_stats['hits'] += 1
+        return _sdm_memo[key]
+
+    path = os.path.join(cache_dir, f'{key}.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            params = tuple(json.load(f)['params'])
+        sdm_cache_stats['disk_hits'] += 1
+    else:
+        params = tuple(float(p) for p in ivtools.sdm.fit_cec_sam(celltype=module['celltype'],
+                                                                 v_mp=module['V_mp_ref'],
+                                                                 i_mp=module['I_mp_ref'],
+                                                                 v_oc=module['V_oc_ref'],
+                                                                 i_sc=module['I_sc_ref'],
+                                                                 alpha_sc=module['alpha_sc'],
+                                                                 beta_voc=module['beta_oc'],
+                                                                 gamma_pmp=module['gamma_pmp'],
+                                                                 cells_in_series=module['cells_in_series'],
+                                                                 temp_ref=module['temp_ref']))
+        sdm_cache_stats['misses'] += 1
+
+        # Temporary file of this writer: processes fitting the same datasheet write the same content, the last one wins
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f'{key}.', suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'specs': {field: module[field] for field in sdm_fields}, 'params': params}, f)
+        os.replace(tmp_path, path)
+
+    _sdm_memo[key] = params
+    return params
+
+def clear_sdm_cache(module=None, cache_dir=None, disk=True):
+    # Invalidate one module (or all modules) in memory and, optionally, on disk
+    cache_dir = cache_dir or sdm_cache_dir
+    keys = [sdm_key(module)] if module is not None else list(_sdm_memo)
+    if module is None and disk and os.path.isdir(cache_dir):
+        keys += [f[:-5] for f in os.listdir(cache_dir) if f.endswith('.json')]
+
+    for key in set(keys):
+        _sdm_memo.pop(key, None)
+        path = os.path.join(cache_dir, f'{key}.json')
+        if disk and os.path.exists(path):
+            os.remove(path)
+
+def find_param_bounds(ref_params, module, pmp_min, pmp_max, tol=1E-4, max_iter=60):
+    ''' Inputs:
+    ref_params: reference SDM parameters [IL, Io, Rs, Rsh, a]
+    module: module specs (dictionary)
+    pmp_min, pmp_max: power limits (W) defining the bounds of each parameter
+    tol: accuracy of the multipliers
+    max_iter: maximum number of bracketing and bisection iterations
+    Output: multipliers (p_dec, p_inc) of the reference values where Pmp crosses pmp_min and pmp_max
+    The 10 bounds (5 parameters x lower/upper) are solved together with a vectorized bracketing + bisection '''
+
+    n = len(ref_params)
+    ref_params = np.asarray(ref_params, dtype=float)
+
+    def get_pmp(rows, m):
+        p = np.ones((len(rows), n))
+        p[np.arange(len(rows)), rows % n] = m
+        IL, Io, Rs, Rsh, a = (ref_params*p).T
+        return np.asarray(pvsystem.singlediode(IL, Io, Rs, Rsh, a)['p_mp'])
+
+    # Direction in which each parameter has to move to decrease the power (1 step of 0.01 below the reference)
+    rows = np.arange(2*n)
+    sign = np.where(get_pmp(rows[:n], 0.99) < module['P_mp_ref'], 1, -1)
+    direction = np.concatenate([-sign, sign]) #rows 0-4: decrease towards pmp_min, rows 5-9: increase towards pmp_max
+
+    def crossed(pmp):
+        # NaN counts as crossed, like the comparisons of the former stepping loops
+        return np.concatenate([~(pmp[:n] > pmp_min), ~(pmp[n:] < pmp_max)])
+
+    # Bracketing: move away from the reference with doubling steps (geometric towards 0)
+    lo, hi = np.ones(2*n), np.ones(2*n)
+    found = np.zeros(2*n, dtype=bool)
+    for k in range(max_iter):
+        step = 0.01 * 2**k
+        m = np.where(direction > 0, 1 + step, 1/(1 + step))
+        hit = crossed(get_pmp(rows, m)) & ~found
+        lo[~found] = hi[~found]
+        hi[~found] = m[~found]
+        found |= hit
+        if found.all():
+            break
+
+    # Bisection: keep the multiplier on the crossed side of the bracket
+    for _ in range(max_iter):
+        if np.all(np.abs(hi - lo)[found] <= tol):
+            break
+        mid = (lo + hi)/2
+        hit = crossed(get_pmp(rows, mid))
+        hi, lo = np.where(found & hit, mid, hi), np.where(found & ~hit, mid, lo)
+
+    p_dec, p_inc = hi[:n].copy(), hi[n:].copy()
+
+    IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref = ref_params
+    if pvsystem.singlediode(IL_ref, Io_ref, Rs_ref*1E-3, Rsh_ref, a_ref)['p_mp'] < pmp_max:  #in some cases even if Rs drops to 0 the power is still lower than the desired value
+        p_inc[2] = 1E-2
+    if pvsystem.singlediode(IL_ref, Io_ref, Rs_ref, Rsh_ref*1E4, a_ref)['p_mp'] < pmp_max: #above a certain threshold Rsh no longer impacts  Pmpp
+        p_inc[3] = 1 + module['power_tolerance']/100
+
+    return p_dec, p_inc
+
+def energy_ratio(data, module, freq=0.5):
     ''' Inputs:
     data: DataFrame of production data
     module: module specs (dictionary)
     freq: frequency of measurements in min
-    meas_unc: measurement uncertainty (%)
-    nb_vals: number of discrete values considered for each parameter (list) '''
+    Output: ratio between measured and "ideal" energy production (pv_perf_drop) '''
 
     # Calculate the amount of energy (kWh) produced by the PV system during the analysis period
     pv_perf = pd.DataFrame(index=['Measured', 'Ideal'], columns=['Energy Production'])
     pv_perf.loc['Measured'] = data['Pmpp'].sum()*freq/60/1000
 
     # Calculate the amount of energy (kWh) that would be "ideally" produced by the PV system
-    IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, module['Adjust'] = ivtools.sdm.fit_cec_sam(celltype=module['celltype'],
-                                                                                       v_mp=module['V_mp_ref'],
-                                                                                       i_mp=module['I_mp_ref'],
-                                                                                       v_oc=module['V_oc_ref'],
-                                                                                       i_sc=module['I_sc_ref'],
-                                                                                       alpha_sc=module['alpha_sc'],
-                                                                                       beta_voc=module['beta_oc'],
-                                                                                       gamma_pmp=module['gamma_pmp'],
-                                                                                       cells_in_series=module['cells_in_series'],
-                                                                                       temp_ref=module['temp_ref'])
+    IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, module['Adjust'] = fit_sdm(module)
 
     IL_adj, Io_adj, Rs_adj, Rsh_adj, a_adj = pvsystem.calcparams_cec(data['GPOA'], data['Tmod'],
                                                                         alpha_sc=module['alpha_sc'],
@@ -183,12 +755,22 @@ def search_space(data, module, nb_vals=[5]*5, freq=0.5, meas_unc=7.2):
 
     Rs_adj = 1000/data['GPOA']*Rs_adj
 
-    mpp_sim = pvsystem.max_power_point(photocurrent=IL_adj, saturation_current=Io_adj, resistance_series=Rs_adj, resistance_shunt=Rsh_adj, nNsVth=a_adj)
+    mpp_sim = max_power_point_warm(IL_adj, Io_adj, Rs_adj, Rsh_adj, a_adj)
 
     pv_perf.loc['Ideal'] = mpp_sim['p_mp'].sum()*freq/60/1000
 
     # Calculate the (extreme) performance drop w.r.t. ideal production
-    pv_perf_drop = float(pv_perf.loc['Measured']/pv_perf.loc['Ideal'])
+    return float(pv_perf.loc['Measured', 'Energy Production']/pv_perf.loc['Ideal', 'Energy Production'])
+
+def build_search_space(module, pv_perf_drop, nb_vals=[5]*5, meas_unc=7.2, tol=1E-4, max_iter=60):
+    ''' Inputs:
+    module: module specs (dictionary)
+    pv_perf_drop: ratio between measured and ideal energy production (see energy_ratio)
+    nb_vals, meas_unc, tol, max_iter: see search_space
+    Output: param_ranges, pruned grid with its STC MPP (i_mp, v_mp, p_mp)
+    The index of the grid is the position of each combination in the full nb_vals grid '''
+
+    IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, module['Adjust'] = fit_sdm(module)
 
     max_perf_drop = pv_perf_drop * (1-meas_unc/100) / (1+module['power_tolerance']/100)
     print('pv_perf_drop loss, max_perf_drop: ', float(pv_perf_drop)*100, float(max_perf_drop)*100)
@@ -196,89 +778,203 @@ def search_space(data, module, nb_vals=[5]*5, freq=0.5, meas_unc=7.2):
     module['P_mp_ref'] = module['V_mp_ref']*module['I_mp_ref']
     pmp_min = module['P_mp_ref']*max_perf_drop
     pmp_max = module['P_mp_ref']*(1+module['power_tolerance']/100)
+    module['pmp_min'], module['pmp_max'] = pmp_min, pmp_max
 
     ref_params = [IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref]
-    param_ranges = []
+    p_dec, p_inc = find_param_bounds(ref_params, module, pmp_min, pmp_max, tol=tol, max_iter=max_iter)
 
+    param_ranges = []
     for i in range(len(ref_params)):
-        p = [1]*5
-        sign = 1
-        p[i] -= 0.01*sign
-
-        IL, Io, Rs, Rsh, a = np.multiply(ref_params, p)
-        pmp = pvsystem.singlediode(IL, Io, Rs, Rsh, a)['p_mp']
-
-        if pmp < module['P_mp_ref']:
-            sign = 1
-        else:
-            sign = -1
-
-        while pmp > pmp_min:
-            p[i] -= 0.01*sign
-            IL, Io, Rs, Rsh, a = np.multiply(ref_params, p)
-            pmp = pvsystem.singlediode(IL, Io, Rs, Rsh, a)['p_mp']
-
-        p_dec = p[i]
-
-        if i == 2 and pvsystem.singlediode(IL_ref, Io_ref, Rs_ref*1E-3, Rsh_ref, a_ref)['p_mp'] < pmp_max:  #in some cases even if Rs drops to 0 the power is still lower than the desired value
-            p[i] = 1E-2
-            pmp = pmp_max
-        elif i == 3 and pvsystem.singlediode(IL_ref, Io_ref, Rs_ref, Rsh_ref*1E4, a_ref)['p_mp'] < pmp_max: #above a certain threshold Rsh no longer impacts  Pmpp
-            p[i] = 1 + module['power_tolerance']/100
-            pmp = pmp_max
-        else:
-            p[i] = 1
-            p[i] += 0.01 * sign
-
-        while pmp < pmp_max:
-            p[i] += 0.01*sign
-            IL, Io, Rs, Rsh, a = np.multiply(ref_params, p)
-            pmp = pvsystem.singlediode(IL, Io, Rs, Rsh, a)['p_mp']
-
-        p_inc = p[i]
-
         ref_value = ref_params[i]
         if i == 1:
-            param_ranges.append(np.logspace(np.log10(ref_value*min(p_dec, p_inc)), np.log10(ref_value*max(p_dec, p_inc)), nb_vals[i]))
+            param_ranges.append(np.logspace(np.log10(ref_value*min(p_dec[i], p_inc[i])), np.log10(ref_value*max(p_dec[i], p_inc[i])), nb_vals[i]))
         else:
-            param_ranges.append(np.linspace(ref_value*min(p_dec, p_inc), ref_value*max(p_dec, p_inc), nb_vals[i]))
-
-    combs = list(itertools.product(*param_ranges)) #get all the possible parameter combinations
+            param_ranges.append(np.linspace(ref_value*min(p_dec[i], p_inc[i]), ref_value*max(p_dec[i], p_inc[i]), nb_vals[i]))
 
-    ss = pd.DataFrame(combs, columns=['IL', 'Io', 'Rs', 'Rsh', 'a'])
-    ss['Rsh'][ss['Rsh'] < 0] = 1
+    # Get all the possible parameter combinations (same order as itertools.product)
+    IL, Io, Rs, Rsh, a = [grid.ravel() for grid in np.meshgrid(*param_ranges, indexing='ij')]
+    Rsh[Rsh < 0] = 1
 
     # Remove unnecessary combinations to evaluate
-    ss[['i_mp', 'v_mp', 'p_mp']] = pvsystem.max_power_point(ss['IL'], ss['Io'], ss['Rs'], ss['Rsh'], ss['a'])
-    ss = ss[ss['p_mp'] >= pmp_min]
-    ss = ss[ss['p_mp'] <= pmp_max]
-
-    return param_ranges, ss
+    mpp = max_power_point_warm(IL, Io, Rs, Rsh, a)
+    keep = np.flatnonzero((mpp['p_mp'] >= pmp_min) & (mpp['p_mp'] <= pmp_max))
 
-def get_daily_data(data, gpoa_interval=100, points_gpoa_bin=5, temp_interval=5, points_temp_bin=5):
-    # Irradiance bins
-    data['gpoa_bin'] = np.floor(data['GPOA'] / gpoa_interval) * gpoa_interval  #split gpoa data into bins
-    gpoa_count = data['gpoa_bin'].value_counts()  #count the number of data points per bin
-    data_gpoa = data[data['gpoa_bin'].isin(gpoa_count[gpoa_count > points_gpoa_bin].index)]
+    ss = pd.DataFrame({'IL': IL[keep], 'Io': Io[keep], 'Rs': Rs[keep], 'Rsh': Rsh[keep], 'a': a[keep],
+                       'i_mp': mpp['i_mp'][keep], 'v_mp': mpp['v_mp'][keep], 'p_mp': mpp['p_mp'][keep]}, index=keep)
 
-    gpoa_dates = []
-    for gpoa_val in data_gpoa['gpoa_bin'].unique():
-        gpoa_dates.extend(data[data['gpoa_bin']==gpoa_val].sample(points_gpoa_bin, random_state=0).index)
+    return param_ranges, ss
 
-    # Temperature bins
-    data['temp_bin'] = np.floor(data['Tmod'] / temp_interval) * temp_interval  #split temp data into bins
-    temp_count = data['temp_bin'].value_counts()  #count the number of data points per bin
-    data_temp = data[data['temp_bin'].isin(temp_count[temp_count > points_temp_bin].index)]
+def search_space(data, module, nb_vals=[5]*5, freq=0.5, meas_unc=7.2, tol=1E-4, max_iter=60):
+    ''' Inputs:
+    data: DataFrame of production data
+    module: module specs (dictionary)
+    freq: frequency of measurements in min
+    meas_unc: measurement uncertainty (%)
+    nb_vals: number of discrete values considered for each parameter (list)
+    tol, max_iter: accuracy and iteration cap of the parameter bounds search (see find_param_bounds) '''
 
-    temp_dates = []
-    for temp_val in data_temp['temp_bin'].unique():
-        temp_dates.extend(data[data['temp_bin']==temp_val].sample(points_temp_bin, random_state=0).index)
+    with stage('search_space', nb_vals=list(nb_vals)) as counts:
+        pv_perf_drop = energy_ratio(data, module, freq)
+        param_ranges, ss = build_search_space(module, pv_perf_drop, nb_vals, meas_unc, tol, max_iter)
+        counts['grid'] = len(ss)
 
-    train_dates = set(gpoa_dates + temp_dates)
+    return param_ranges, ss
 
-    return data.loc[list(train_dates)]
+# Versioned on-disk artifacts of the search space (bump the version when build_search_space or the layout changes)
+search_space_version = 4
+search_space_cache_dir = 'search_space_cache'
+ss_columns = ['IL', 'Io', 'Rs', 'Rsh', 'a', 'i_mp', 'v_mp', 'p_mp']
+mpp_columns = ['i_mp', 'v_mp', 'p_mp']
+
+# Memory budget (MB) of the large temporaries: chunks of combinations (or of days) are sized to stay within it
+memory_budget = 1024
+
+def budget_rows(row_bytes, share=1.0):
+    # Number of rows of row_bytes bytes fitting in a share of the memory budget (at least 1)
+    return max(1, int(memory_budget*share*1024**2 // max(row_bytes, 1)))
+
+def compact_grid(param_ranges, bpe):
+    ''' Compact form of the search space: the parameter values are not stored, only the position of each
+    combination on the five parameter axes, and its STC MPP
+    Inputs: param_ranges, bpe: see search_space
+    Output: dictionary of ranges (param_ranges), axes (n, 5) int16 (int32 above 32767 values per axis) and mpp (n, 3) '''
+
+    nb_vals = [len(values) for values in param_ranges]
+    axes = np.stack(np.unravel_index(bpe.index.to_numpy(), nb_vals), axis=1)
+    return {'ranges': [np.asarray(values, dtype=np.float64) for values in param_ranges],
+            'axes': axes.astype(np.int16 if max(nb_vals) <= np.iinfo(np.int16).max else np.int32),
+            'mpp': bpe[mpp_columns].to_numpy(dtype=np.float64)}
+
+def grid_size(grid):
+    # Number of combinations of a search space (DataFrame or compact grid)
+    return len(grid) if isinstance(grid, pd.DataFrame) else len(grid['axes'])
+
+def grid_values(grid, columns, start=0, stop=None):
+    ''' Values of columns (of ss_columns) for the combinations start:stop of a search space, materialized on demand
+    for a compact grid (Rsh clipped as in build_search_space)
+    Output: float64 array (n, len(columns)) '''
+
+    if isinstance(grid, pd.DataFrame):
+        return grid.iloc[start:stop][columns].to_numpy(dtype=np.float64)
+
+    axes = grid['axes'][start:stop]
+    values = np.empty((len(axes), len(columns)))
+    for j, column in enumerate(columns):
+        if column in mpp_columns:
+            values[:, j] = grid['mpp'][start:stop, mpp_columns.index(column)]
+        else:
+            i = ss_columns.index(column)
+            values[:, j] = grid['ranges'][i][axes[:, i]]
+            if column == 'Rsh':
+                values[values[:, j] < 0, j] = 1
+    return values
+
+def grid_take(grid, rows):
+    # Subset of the combinations of a search space (boolean mask or positions)
+    if isinstance(grid, pd.DataFrame):
+        return grid[rows] if np.asarray(rows).dtype == bool else grid.iloc[rows]
+    return {'ranges': grid['ranges'], 'axes': grid['axes'][rows], 'mpp': grid['mpp'][rows]}
+
+def grid_frame(grid):
+    # DataFrame of the search space (columns ss_columns, index = position in the full grid) from a compact grid
+    nb_vals = [len(values) for values in grid['ranges']]
+    index = np.ravel_multi_index(np.asarray(grid['axes'], dtype=np.int64).T, nb_vals)
+    return pd.DataFrame(grid_values(grid, ss_columns), columns=ss_columns, index=index)
+
+def search_space_key(module, nb_vals, meas_unc, pv_perf_drop, tol=1E-4, max_iter=60):
+    specs = {'version': search_space_version, 'module': sdm_key(module), 'power_tolerance': module['power_tolerance'],
+             'nb_vals': list(nb_vals), 'meas_unc': meas_unc, 'pv_perf_drop': round(pv_perf_drop, 6),
+             'tol': tol, 'max_iter': max_iter}
+    return hashlib.sha256(json.dumps(specs, sort_keys=True).encode()).hexdigest()[:16], specs
+
+def load_search_space(data, module, nb_vals=[5]*5, freq=0.5, meas_unc=7.2, tol=1E-4, max_iter=60, cache_dir=None, compact=False):
+    ''' Same as search_space, but the pruned grid is stored in compact form (see compact_grid) as a .npy bundle keyed
+    by module, nb_vals, meas_unc and measured energy ratio, and lazily loaded (memory-mapped) on later runs
+    Inputs: see search_space
+    cache_dir: directory of the artifacts (default: search_space_cache_dir)
+    compact: return the compact grid instead of the DataFrame of the parameter values '''
+
+    with stage('search_space', nb_vals=list(nb_vals)) as counts:
+        cache_dir = cache_dir or search_space_cache_dir
+        pv_perf_drop = energy_ratio(data, module, freq)
+        key, specs = search_space_key(module, nb_vals, meas_unc, pv_perf_drop, tol, max_iter)
+        path = os.path.join(cache_dir, key)
+
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            module['P_mp_ref'] = module['V_mp_ref']*module['I_mp_ref']
+            module['pmp_min'], module['pmp_max'] = meta['pmp_min'], meta['pmp_max']
+            param_ranges = [np.load(os.path.join(path, f'range_{i}.npy')) for i in range(5)]
+            grid = {'ranges': param_ranges, 'axes': np.load(os.path.join(path, 'axes.npy'), mmap_mode='r'),
+                    'mpp': np.load(os.path.join(path, 'mpp.npy'), mmap_mode='r')}
+            counts.update(cached=True, grid=grid_size(grid))
+            return param_ranges, grid if compact else grid_frame(grid)
+
+        param_ranges, ss = build_search_space(module, pv_perf_drop, nb_vals, meas_unc, tol, max_iter)
+        grid = compact_grid(param_ranges, ss)
+        counts.update(cached=False, grid=len(ss))
+
+        # Temporary directory of this writer, renamed unless another process already stored the same search space
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=f'{key}.', suffix='.tmp')
+        for i, param_range in enumerate(param_ranges):
+            np.save(os.path.join(tmp_path, f'range_{i}.npy'), param_range)
+        np.save(os.path.join(tmp_path, 'axes.npy'), grid['axes'])
+        np.save(os.path.join(tmp_path, 'mpp.npy'), grid['mpp'])
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(dict(specs, rows=len(ss), pmp_min=module['pmp_min'], pmp_max=module['pmp_max']), f)
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.exists(os.path.join(path, 'meta.json')):
+                raise
+
+        return param_ranges, grid if compact else ss
+
+def get_daily_data(data, gpoa_interval=100, points_gpoa_bin=5, temp_interval=5, points_temp_bin=5, seed=0):
+    ''' Stratified sampling of the training data: points_gpoa_bin points of each irradiance bin and
+    points_temp_bin points of each temperature bin having more points than that
+    Inputs:
+    data: DataFrame of production data of one day, or of several days (each calendar day is sampled on its own)
+    gpoa_interval, temp_interval: width of the irradiance and temperature bins
+    seed: seed of the random sampling (a day gets the same sample alone or within a range of days)
+    Output: sampled rows of data in time order (data is not modified) '''
+
+    n = len(data)
+    day = data.index.values.astype('datetime64[D]').astype(np.int64) #calendar day number
+    days, day_idx = np.unique(day, return_inverse=True)
+
+    # Random sort keys (independent for the two binnings), drawn by a generator per day
+    keys = np.empty((n, 2))
+    day_order = np.argsort(day_idx, kind='stable')
+    keys[day_order] = np.concatenate([np.random.default_rng([seed, int(d)]).random((count, 2))
+                                      for d, count in zip(days, np.bincount(day_idx, minlength=len(days)))] or [np.empty((0, 2))])
+
+    train = np.zeros(n, dtype=bool)
+    binnings = [(data['GPOA'], gpoa_interval, points_gpoa_bin), (data['Tmod'], temp_interval, points_temp_bin)]
+    for (values, interval, points), key in zip(binnings, keys.T):
+        bins = np.floor(values.to_numpy(dtype=np.float64) / interval) #split data into bins
+        valid = ~np.isnan(bins)
+
+        # Sort by (day, bin, key): the first `points` rows of each (day, bin) group are a random sample of the bin
+        order = np.lexsort((key, bins, day_idx))
+        group_start = np.r_[True, (np.diff(day_idx[order]) != 0) | (np.diff(bins[order]) != 0)]
+        group = np.cumsum(group_start) - 1
+        starts = np.flatnonzero(group_start)
+        size = np.diff(np.r_[starts, n])[group]
+        rank = np.arange(n) - starts[group]
+
+        sampled = (rank < points) & (size > points) & valid[order] #only bins with more than `points` points
+        train[order[sampled]] = True
+
+    return data[train]
 
 def get_likelihood(IL, Io, Rs, Rsh, a, daily_data, alpha_sc, Adjust):
+    from sklearn.metrics import mean_absolute_percentage_error as mape
+    from sklearn.metrics import mean_squared_error as mse
+
     IL_adj, Io_adj, Rs_adj, Rsh_adj, a_adj = pvsystem.calcparams_cec(daily_data['GPOA'], daily_data['Tmod'],
                                                         alpha_sc=alpha_sc,
                                                         I_L_ref=IL,
@@ -299,305 +995,1736 @@ def get_likelihood(IL, Io, Rs, Rsh, a, daily_data, alpha_sc, Adjust):
 
     return np.exp(-err)
 
-"""###K-means"""
-
-from sklearn.cluster import KMeans
-
-# Import data
-pv_tech = 'cSi'
-save_dir = 'results'
-
-data = pd.read_csv(f'data_{pv_tech}.csv')
-data['Date'] = pd.to_datetime(data['Date'])
-data = data.set_index('Date')
-
-data = data.loc['2022':'2022-03-31']
-
-from google.colab import drive
-drive.mount('/content/drive')
-
-# Define module datasheet specs
-module = modules[pv_tech]
-
-pip install nrel-pysam
-
-# Estimate the reference SDM parameters using datasheet specs
-IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, module['Adjust'] = ivtools.sdm.fit_cec_sam(
-    celltype=module['celltype'],
-    v_mp=module['V_mp_ref'],
-    i_mp=module['I_mp_ref'],
-    v_oc=module['V_oc_ref'],
-    i_sc=module['I_sc_ref'],
-    alpha_sc=module['alpha_sc'],
-    beta_voc=module['beta_oc'],
-    gamma_pmp=module['gamma_pmp'],
-    cells_in_series=module['cells_in_series'],
-    temp_ref=module['temp_ref']
-)
-
-# Define search space
-param_ranges, bpe = search_space(data, module, nb_vals=[10]*5, freq=0.5, meas_unc=7.2)
-print(len(bpe))
-
-# Choose number of days to evaluate
-days = np.array(sorted(set(data.index.date)))
-conf_intervals = pd.DataFrame()
-th_pm = 90 #90% confidence interval
-
-num_clusters = 5 # количество кластеров
-kmeans = KMeans(n_clusters=num_clusters)
-for day in days:
-    day = day.strftime('%Y-%m-%d')
-    print(day)
-    daily_data = get_daily_data(data.loc[day], points_gpoa_bin=3, points_temp_bin=3)
-    if len(daily_data) > 10:
-        print(day)
+# Batched MPP solver warm-started from the STC maximum power point of each combination
+# Newton on dP/dVd = 0 with the diode voltage Vd as variable (same parametrization as pvlib's bishop88):
+# I = IL - Io*(exp(Vd/a) - 1) - Vd/Rsh, V = Vd - I*Rs
+
+def _mpp_derivatives(IL, Io, Rs, Rsh, a, vd):
+    e = np.exp(vd/a)
+    i = IL - Io*(e - 1) - vd/Rsh
+    di = -Io*e/a - 1/Rsh
+    d2i = -Io*e/a**2
+    v = vd - i*Rs
+    dv = 1 - di*Rs
+    dp = di*v + i*dv
+    d2p = d2i*v + 2*di*dv - i*Rs*d2i
+    return i, v, dp, d2p
+
+def _mpp_newton_numpy(IL, Io, Rs, Rsh, a, vd, vd_max, tol, max_iter):
+    # Only the elements not converged yet are updated at each iteration
+    active = np.arange(vd.size)
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        args = [x[active] for x in (IL, Io, Rs, Rsh, a)]
+        _, _, dp, d2p = _mpp_derivatives(*args, vd[active])
+        concave = d2p < 0
+        step = np.where(concave, -dp/np.where(concave, d2p, -1), np.sign(dp)*0.1*args[4]) #uphill step where P is not concave
+        new = np.clip(vd[active] + step, 0, vd_max[active])
+        converged = np.abs(new - vd[active]) <= tol
+        vd[active] = new
+        active = active[~converged]
+    return vd
+
+def _mpp_newton_loop(IL, Io, Rs, Rsh, a, vd, vd_max, tol, max_iter):
+    # Same iteration as _mpp_newton_numpy, element by element (compiled with numba)
+    for k in range(vd.size):
+        x = vd[k]
+        for _ in range(max_iter):
+            _, _, dp, d2p = _mpp_derivatives_jit(IL[k], Io[k], Rs[k], Rsh[k], a[k], x)
+            step = -dp/d2p if d2p < 0 else np.sign(dp)*0.1*a[k]
+            new = min(max(x + step, 0.0), vd_max[k])
+            converged = abs(new - x) <= tol
+            x = new
+            if converged:
+                break
+        vd[k] = x
+    return vd
+
+_mpp_jit = {}
+
+def _mpp_newton_jit():
+    # _mpp_newton_loop compiled with numba on first use (numba is slow to import), None when numba is not installed
+    global _mpp_derivatives_jit
+    if 'loop' not in _mpp_jit:
+        try:
+            import numba
+        except ImportError:
+            _mpp_jit['loop'] = None
+        else:
+            _mpp_derivatives_jit = numba.njit(cache=True)(_mpp_derivatives)
+            _mpp_jit['loop'] = numba.njit(cache=True)(_mpp_newton_loop)
+    return _mpp_jit['loop']
 
-        bpe['Likelihood'] = bpe.apply(lambda row: get_likelihood(row['IL'], row['Io'], row['Rs'], row['Rsh'], row['a'], daily_data, module['alpha_sc'], module['Adjust']), axis=1)
+def mpp_seed(IL, Io, a, stc):
+    ''' Starting diode voltage of max_power_point_warm from the STC maximum power point
+    Inputs:
+    IL, Io, a: SDM parameters at the operating conditions
+    stc: dictionary of the STC parameters and MPP of the same combinations (IL, Io, Rs, a, i_mp, v_mp)
+    The STC diode voltage at the MPP is scaled like the open-circuit voltage a*ln(1+IL/Io) '''
 
-        kmeans.fit(bpe[['Likelihood']])
-        bpe['Cluster'] = kmeans.labels_
+    vd_stc = stc['v_mp'] + stc['i_mp']*stc['Rs']
+    return vd_stc * (a*np.log1p(IL/Io)) / (stc['a']*np.log1p(stc['IL']/stc['Io']))
 
-        # Получаем средние значения для каждого кластера
-        cluster_means = bpe.groupby('Cluster').mean().reset_index()
+def max_power_point_warm(IL, Io, Rs, Rsh, a, vd_start=None, tol=1E-9, max_iter=50, use_numba=None):
+    ''' Inputs:
+    IL, Io, Rs, Rsh, a: SDM parameters (broadcast together, Rs already scaled with the irradiance if needed)
+    vd_start: starting diode voltage (see mpp_seed), 85% of the open-circuit estimate if None
+    tol: convergence of the diode voltage (V), checked per element
+    max_iter: maximum number of Newton iterations
+    use_numba: use the JIT-compiled loop (default: when numba is installed)
+    Output: dictionary of i_mp, v_mp, p_mp (as pvsystem.max_power_point) '''
+
+    # Copies: the outputs of broadcast_arrays are views that must not reach the JIT loop
+    arrays = np.broadcast_arrays(IL, Io, Rs, Rsh, a)
+    shape = arrays[0].shape
+    IL, Io, Rs, Rsh, a = [np.array(x, dtype=float).ravel() for x in arrays]
+
+    vd_max = a*np.log1p(IL/Io) #open-circuit diode voltage without shunt losses (upper bound)
+    if vd_start is None:
+        vd = 0.85*vd_max
+    else:
+        vd = np.clip(np.broadcast_to(vd_start, shape).astype(float).ravel(), 0, vd_max)
 
-        # Получаем 90% доверительный интервал
-        conf_int = cluster_means.sort_values('Likelihood', ascending=False)
-        conf_int.index = [day] * len(conf_int)
+    newton_loop = _mpp_newton_jit() if use_numba is not False else None
+    if use_numba and newton_loop is None:
+        raise ImportError('numba is not installed')
+    if newton_loop is not None:
+        vd = newton_loop(IL, Io, Rs, Rsh, a, vd, vd_max, tol, max_iter)
+    else:
+        vd = _mpp_newton_numpy(IL, Io, Rs, Rsh, a, vd, vd_max, tol, max_iter)
+
+    i_mp, v_mp, _, _ = _mpp_derivatives(IL, Io, Rs, Rsh, a, vd)
+    return {'i_mp': i_mp.reshape(shape), 'v_mp': v_mp.reshape(shape), 'p_mp': (i_mp*v_mp).reshape(shape)}
+
+def validate_mpp(IL, Io, Rs, Rsh, a, vd_start=None, rtol=1E-6, use_numba=None):
+    ''' Compare max_power_point_warm with pvsystem.max_power_point (brentq)
+    Output: maximum relative error of i_mp, v_mp and p_mp, True if all of them are below rtol '''
+
+    warm = max_power_point_warm(IL, Io, Rs, Rsh, a, vd_start=vd_start, use_numba=use_numba)
+    ref = pvsystem.max_power_point(IL, Io, Rs, Rsh, a)
+    errors = {key: float(np.max(np.abs(warm[key] - ref[key]) / np.maximum(np.abs(ref[key]), np.finfo(np.float64).eps)))
+              for key in ['i_mp', 'v_mp', 'p_mp']}
+
+    return errors, all(err <= rtol for err in errors.values())
+
+def get_likelihood_grid(bpe, daily_data, alpha_sc, Adjust, mem_cap=None, method='warm'):
+    ''' Batched version of get_likelihood over all the combinations of the search space
+    Inputs:
+    bpe: DataFrame of SDM parameter combinations (columns IL, Io, Rs, Rsh, a), or compact grid (see compact_grid)
+    daily_data: DataFrame of training data of the day
+    alpha_sc, Adjust: module temperature coefficient and CEC adjustment
+    mem_cap: approximate memory (MB) allowed per chunk of combinations (default: a quarter of memory_budget)
+    method: 'warm' for max_power_point_warm (seeded from the STC MPP columns i_mp/v_mp of bpe when present),
+    otherwise root finder used by pvsystem.max_power_point ('newton' is vectorized, 'brentq' is not)
+    Output: array of likelihoods, equal to get_likelihood row by row within rtol=1e-6 for float64 daily_data
+    (the samples are always upcast to float64 here, while get_likelihood computes in float32 on float32 data,
+    e.g. from the data store: the two then differ by up to rtol=1e-4) '''
+
+    ape_sum, se_sum = likelihood_error_sums(bpe, daily_data, alpha_sc, Adjust, mem_cap, method)
+    return likelihood_from_sums(ape_sum, se_sum, len(daily_data))
+
+def likelihood_from_sums(ape_sum, se_sum, n_samples):
+    # MAPE [%] and RMSE averaged over the 3 variables and all samples (as sklearn does with uniform_average)
+    mape_err = ape_sum / (3*n_samples)*100
+    rmse_err = np.sqrt(se_sum / (3*n_samples))
+    return np.exp(-(mape_err+rmse_err)/2)
+
+def likelihood_error_sums(bpe, daily_data, alpha_sc, Adjust, mem_cap=None, method='warm'):
+    ''' Sums over the samples of the absolute percentage errors and of the squared errors of Impp, Vmpp and Pmpp
+    for each combination: the likelihood only depends on these sums (see likelihood_from_sums), so they can be
+    accumulated as the samples arrive
+    Inputs: see get_likelihood_grid
+    Output: arrays ape_sum, se_sum '''
+
+    gpoa = daily_data['GPOA'].to_numpy(dtype=float)[np.newaxis, :]
+    tmod = daily_data['Tmod'].to_numpy(dtype=float)[np.newaxis, :]
+    meas = [daily_data[col].to_numpy(dtype=float)[np.newaxis, :] for col in ['Impp', 'Vmpp', 'Pmpp']]
+    meas_abs = [np.maximum(np.abs(m), np.finfo(np.float64).eps) for m in meas] #same denominator as sklearn's MAPE
+
+    # The parameter values are materialized chunk by chunk (STC MPP seeds when the search space has them)
+    seeded = not isinstance(bpe, pd.DataFrame) or {'i_mp', 'v_mp'} <= set(bpe.columns)
+    columns = ['IL', 'Io', 'Rs', 'Rsh', 'a'] + (['i_mp', 'v_mp'] if seeded else [])
+    n_combs, n_samples = grid_size(bpe), gpoa.shape[1]
+
+    # ~40 float64 temporaries per (combination, sample) element inside calcparams_cec/max_power_point
+    mem_cap = memory_budget/4 if mem_cap is None else mem_cap
+    chunk = max(1, int(mem_cap*1024**2 / (40*8*max(n_samples, 1))))
+
+    ape_sum, se_sum = np.empty(n_combs), np.empty(n_combs)
+    for start in range(0, n_combs, chunk):
+        values = grid_values(bpe, columns, start, start+chunk).T[:, :, np.newaxis]
+        IL, Io, Rs, Rsh, a = values[:5]
+
+        IL_adj, Io_adj, _, Rsh_adj, a_adj = pvsystem.calcparams_cec(gpoa, tmod, alpha_sc=alpha_sc,
+                                                                    I_L_ref=IL, I_o_ref=Io, R_s=Rs,
+                                                                    R_sh_ref=Rsh, a_ref=a, Adjust=Adjust)
+        Rs_adj = np.broadcast_to(1000/gpoa*Rs, IL_adj.shape)
+
+        if method != 'warm':
+            mpp_sim = pvsystem.max_power_point(IL_adj, Io_adj, Rs_adj, Rsh_adj, a_adj, method=method)
+        elif not seeded:
+            mpp_sim = max_power_point_warm(IL_adj, Io_adj, Rs_adj, Rsh_adj, a_adj)
+        else:
+            i_mp, v_mp = values[5:]
+            stc = {'IL': IL, 'Io': Io, 'Rs': Rs, 'a': a, 'i_mp': i_mp, 'v_mp': v_mp}
+            mpp_sim = max_power_point_warm(IL_adj, Io_adj, Rs_adj, Rsh_adj, a_adj, vd_start=mpp_seed(IL_adj, Io_adj, a_adj, stc))
+        sims = [mpp_sim['i_mp'], mpp_sim['v_mp'], mpp_sim['p_mp']]
 
-        conf_intervals = pd.concat([conf_intervals, conf_int])
+        ape_sum[start:start+chunk] = sum((np.abs(m - s)/m_abs).sum(axis=1) for m, m_abs, s in zip(meas, meas_abs, sims))
+        se_sum[start:start+chunk] = sum(((m - s)**2).sum(axis=1) for m, s in zip(meas, sims))
 
-conf_intervals.index = pd.to_datetime(conf_intervals.index)
+    return ape_sum, se_sum
 
-conf_intervals_iv = pvsystem.singlediode(conf_intervals['IL'], conf_intervals['Io'], conf_intervals['Rs'], conf_intervals['Rsh'], conf_intervals['a'])
-conf_intervals_iv = conf_intervals_iv[['p_mp', 'v_oc', 'i_sc', 'v_mp', 'i_mp']]
+"""###K-means"""
 
-# Print expected values for the module SDM parameters and IV properties
-bpe_iv = pvsystem.singlediode(bpe['IL'], bpe['Io'], bpe['Rs'], bpe['Rsh'], bpe['a'])
+def adaptive_search(param_ranges, daily_data, module, nb_vals=[5]*5, levels=2, keep=0.05):
+    ''' Coarse-to-fine alternative to the evaluation of the full grid
+    Inputs:
+    param_ranges: parameter ranges of the search space (only the bounds are used, Io in log scale)
+    daily_data: DataFrame of training data of the day
+    module: module specs (dictionary), pmp_min/pmp_max prune the combinations as in build_search_space
+    nb_vals: number of values of each parameter in the coarse grid
+    levels: number of refinements (the grid spacing is halved at each level)
+    keep: number of cells refined at each level, as a fraction of the coarse grid (the best cells of the level)
+    Output: DataFrame of all the evaluated combinations (IL, Io, Rs, Rsh, a, i_mp, v_mp, p_mp, Likelihood) '''
+
+    n = len(param_ranges)
+    log_scale = np.arange(n) == 1
+    lo = np.array([np.min(r) for r in param_ranges], dtype=float)
+    hi = np.array([np.max(r) for r in param_ranges], dtype=float)
+    lo[log_scale], hi[log_scale] = np.log10(lo[log_scale]), np.log10(hi[log_scale])
+
+    # Combinations are points of an integer lattice, 2**levels finer than the coarse grid
+    scale = 2**levels
+    dims = np.array([(nb - 1)*scale + 1 for nb in nb_vals])
+    step = (hi - lo) / np.maximum(dims - 1, 1)
+
+    def evaluate(points):
+        values = lo + points*step
+        values[:, log_scale] = 10**values[:, log_scale]
+        IL, Io, Rs, Rsh, a = values.T
+        Rsh[Rsh < 0] = 1
+        mpp = max_power_point_warm(IL, Io, Rs, Rsh, a)
+        ok = (mpp['p_mp'] >= module.get('pmp_min', -np.inf)) & (mpp['p_mp'] <= module.get('pmp_max', np.inf))
+        frame = pd.DataFrame({'IL': IL[ok], 'Io': Io[ok], 'Rs': Rs[ok], 'Rsh': Rsh[ok], 'a': a[ok],
+                              'i_mp': mpp['i_mp'][ok], 'v_mp': mpp['v_mp'][ok], 'p_mp': mpp['p_mp'][ok]})
+        frame['Likelihood'] = get_likelihood_grid(frame, daily_data, module['alpha_sc'], module['Adjust'])
+        return points[ok], frame
+
+    # Coarse grid
+    points = np.stack(np.meshgrid(*[np.arange(nb)*scale for nb in nb_vals], indexing='ij'), axis=-1).reshape(-1, n)
+    points, frame = evaluate(points)
+    codes = np.ravel_multi_index(points.T, dims)
+    frames, cells = [frame], (codes, frame['Likelihood'].to_numpy())
+    all_codes, all_likelihood = codes, frame['Likelihood'].to_numpy()
+    n_keep = max(1, int(np.ceil(keep*len(codes))))
+
+    neighbours = np.stack(np.meshgrid(*[[-1, 0, 1]]*n, indexing='ij'), axis=-1).reshape(-1, n)
+    for level in range(1, levels + 1):
+        # Best cells of the previous level, subdivided with half its spacing
+        cell_codes, cell_likelihood = cells
+        if not len(cell_codes):
+            break
+        best = np.array(np.unravel_index(cell_codes[np.argsort(-cell_likelihood, kind='stable')[:n_keep]], dims)).T
+        children = (best[:, np.newaxis, :] + neighbours*2**(levels - level)).reshape(-1, n)
+        children = children[((children >= 0) & (children < dims)).all(axis=1)]
+        child_codes = np.unique(np.ravel_multi_index(children.T, dims))
+
+        # Evaluate only the new combinations
+        new_codes = child_codes[~np.isin(child_codes, all_codes)]
+        new_points, frame = evaluate(np.array(np.unravel_index(new_codes, dims), dtype=np.int64).T.reshape(-1, n))
+        frames.append(frame)
+        all_codes = np.concatenate([all_codes, np.ravel_multi_index(new_points.T, dims)])
+        all_likelihood = np.concatenate([all_likelihood, frame['Likelihood'].to_numpy()])
+
+        # Cells of this level: the evaluated children (including the centers evaluated before)
+        order = np.argsort(all_codes)
+        pos = np.searchsorted(all_codes, child_codes, sorter=order)
+        found = (pos < len(all_codes)) & (all_codes[order[np.minimum(pos, len(all_codes) - 1)]] == child_codes)
+        cells = (child_codes[found], all_likelihood[order[pos[found]]])
+
+    return pd.concat(frames, ignore_index=True)
+
+def _kmeans_1d_layer(D_prev, c, n, s1, s2):
+    # One layer of the dynamic programming, solved by divide and conquer (the optimal split point is monotonic)
+    # All the sub-problems of a recursion level are evaluated together as flat arrays
+    D, opt = np.full(n, np.inf), np.zeros(n, dtype=np.int64)
+    lo, hi, opt_lo, opt_hi = (np.array([v]) for v in (c, n - 1, c, n - 1))
+    while lo.size:
+        mid = (lo + hi)//2
+        lens = np.minimum(mid, opt_hi) - opt_lo + 1
+        starts = np.cumsum(lens) - lens
+        seg = np.repeat(np.arange(mid.size), lens)
+        j = np.arange(lens.sum()) + (opt_lo - starts)[seg]
+
+        # D_prev[j-1] + sum of squared errors of the sorted values j..mid
+        val = D_prev[j - 1] + (s2[mid + 1][seg] - s2[j]) - (s1[mid + 1][seg] - s1[j])**2/((mid + 1)[seg] - j)
+        best = np.minimum.reduceat(val, starts)
+        first = np.flatnonzero(val == best[seg])
+        first = first[np.r_[True, seg[first][1:] != seg[first][:-1]]] #first split point reaching the minimum
+        D[mid], opt[mid] = best, j[first]
+
+        left, right = lo <= mid - 1, mid + 1 <= hi
+        lo, hi, opt_lo, opt_hi = (np.concatenate([lo[left], mid[right] + 1]), np.concatenate([mid[left] - 1, hi[right]]),
+                                  np.concatenate([opt_lo[left], opt[mid][right]]), np.concatenate([opt[mid][left], opt_hi[right]]))
+    return D, opt
+
+def kmeans_1d(values, num_clusters=5):
+    ''' Exact (optimal) k-means of 1-D data: sort + dynamic programming, O(k n log n), deterministic
+    Inputs:
+    values: 1-D array
+    num_clusters: number of clusters
+    Output: cluster labels (0 = lowest values) '''
+
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    order = np.argsort(values, kind='stable')
+    x = values[order] - np.median(values) #centered for accurate sums of squares
+    s1, s2 = np.r_[0, np.cumsum(x)], np.r_[0, np.cumsum(x**2)]
+
+    k = max(1, min(num_clusters, n))
+    i = np.arange(n)
+    D = s2[i + 1] - s1[i + 1]**2/(i + 1) #one cluster for the values 0..i
+    opts = []
+    for c in range(1, k - 1):
+        D, opt = _kmeans_1d_layer(D, c, n, s1, s2)
+        opts.append(opt)
+
+    # Last layer: only the split of the whole data set is needed
+    labels_sorted = np.zeros(n, dtype=np.int64)
+    if k > 1:
+        j = np.arange(k - 1, n)
+        val = D[j - 1] + (s2[n] - s2[j]) - (s1[n] - s1[j])**2/(n - j)
+        opts.append(np.full(n, j[np.argmin(val)]))
+
+    # Backtrack the cluster boundaries
+    i = n - 1
+    for c in range(k - 1, 0, -1):
+        j = opts[c - 1][i]
+        labels_sorted[j:i + 1] = c
+        i = j - 1
+
+    labels = np.empty(n, dtype=np.int64)
+    labels[order] = labels_sorted
+    return labels
+
+def cluster_likelihood(likelihood, num_clusters=5, clusterer='exact', seed=0):
+    ''' Inputs:
+    likelihood: array of likelihoods of the search space
+    clusterer: 'exact' (optimal 1-D k-means, deterministic) or 'sklearn' (KMeans, seeded)
+    Output: cluster labels '''
+
+    if clusterer == 'exact':
+        return kmeans_1d(likelihood, num_clusters)
+    if clusterer == 'sklearn':
+        from sklearn.cluster import KMeans
+        kmeans = KMeans(n_clusters=num_clusters, random_state=seed)
+        kmeans.fit(np.asarray(likelihood).reshape(-1, 1))
+        return kmeans.labels_
+    raise ValueError(f'Unknown clusterer: {clusterer}')
+
+def axis_indices(bpe, nb_vals):
+    # Integer position of each combination on the axis of each parameter (bpe index = position in the full grid), shape (n, 5)
+    if not isinstance(bpe, pd.DataFrame): #compact grid
+        return np.asarray(bpe['axes'])
+    return np.stack(np.unravel_index(bpe.index.to_numpy(), nb_vals), axis=1).astype(np.int16)
+
+def _axis_sums(weights, codes, size):
+    # Sums of the weights (n_days, n_combinations) of the combinations sharing the same integer code, all the days at once
+    order = np.argsort(codes, kind='stable')
+    present, starts = np.unique(codes[order], return_index=True)
+    sums = np.zeros((weights.shape[0], size))
+    if len(order):
+        sums[:, present] = np.add.reduceat(weights[:, order], starts, axis=1)
+    return sums
+
+def posterior_summary(likelihoods, axes, param_ranges, joint=(('Rs', 'Rsh'),), quantiles=(0.05, 0.5, 0.95)):
+    ''' Posterior distribution of the SDM parameters from the likelihoods of the search space (normalized for each day)
+    Inputs:
+    likelihoods: array (n_days, n_combinations) or (n_combinations,), memory-mapped arrays are read by chunks of days
+    axes: integer axis indices of the combinations (see axis_indices)
+    param_ranges: values of each parameter axis (see search_space)
+    joint: pairs of parameters of the joint 2-D marginals
+    quantiles: levels of the quantiles of the marginals
+    Output: dictionary of arrays (first dimension = day)
+    marginal_{param} (n_days, nb_vals), joint_{param}_{param} (n_days, nb_vals, nb_vals),
+    mean, map (n_days, 5), quantiles (n_days, 5, len(quantiles)), range_{param} and quantile_levels '''
+
+    params = ['IL', 'Io', 'Rs', 'Rsh', 'a']
+    nb_vals = [len(values) for values in param_ranges]
+    if np.ndim(likelihoods) == 2:
+        # Chunks of days within the memory budget (float64 weights and their reordered copy)
+        chunk = budget_rows(3*8*max(np.shape(likelihoods)[1], 1), 0.5)
+        if len(likelihoods) > chunk:
+            return _concat_summaries([posterior_summary(likelihoods[start:start+chunk], axes, param_ranges, joint, quantiles)
+                                      for start in range(0, len(likelihoods), chunk)])
+
+    likelihoods = np.atleast_2d(np.asarray(likelihoods, dtype=np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weights = likelihoods / likelihoods.sum(axis=1, keepdims=True)
+    axes = np.asarray(axes, dtype=np.int64)
+
+    summary = {'quantile_levels': np.asarray(quantiles, dtype=np.float64)}
+    mean, map_values, quantile_values = [], [], []
+    for i, param in enumerate(params):
+        values = np.asarray(param_ranges[i], dtype=np.float64)
+        marginal = _axis_sums(weights, axes[:, i], nb_vals[i])
+        cdf = np.cumsum(marginal, axis=1)
+        summary[f'range_{param}'] = values
+        summary[f'marginal_{param}'] = marginal
+        mean.append(marginal @ values)
+        map_values.append(values[marginal.argmax(axis=1)])
+        quantile_values.append(np.stack([values[np.minimum((cdf < q*cdf[:, -1:]).sum(axis=1), nb_vals[i] - 1)] for q in quantiles], axis=1))
+
+    for p, q in joint:
+        i, j = params.index(p), params.index(q)
+        codes = axes[:, i]*nb_vals[j] + axes[:, j]
+        summary[f'joint_{p}_{q}'] = _axis_sums(weights, codes, nb_vals[i]*nb_vals[j]).reshape(-1, nb_vals[i], nb_vals[j])
+
+    summary.update(mean=np.stack(mean, axis=1), map=np.stack(map_values, axis=1), quantiles=np.stack(quantile_values, axis=1))
+
+    return summary
+
+def warm_start_policy(nb_vals, quantile=0.9, guard=1, full_every=7, shift_thresh=0.5):
+    ''' Day-to-day warm start of the likelihood evaluation (state kept in a dictionary)
+    Inputs:
+    nb_vals: number of values of each parameter of the grid (bpe index = position in the full grid)
+    quantile: combinations above this quantile of the previous-day likelihood are evaluated...
+    guard: ...plus their grid neighbours up to this distance (number of grid steps)
+    full_every: a full sweep of the grid is done at least every full_every days
+    shift_thresh: shift of the top cluster mean (in grid steps, w.r.t. the previous day) triggering a full sweep
+    (above the day-to-day noise of the top cluster mean, about 0.1 to 0.3 grid steps: a re-swept day costs more than a full sweep) '''
+
+    return {'nb_vals': list(nb_vals), 'quantile': quantile, 'guard': guard, 'full_every': full_every, 'shift_thresh': shift_thresh,
+            'previous': None, 'top_mean': None, 'days_since_full': 0, 'evaluated': 0, 'total': 0, 'full_sweeps': 0}
+
+def _top_cluster_mean(bpe, likelihood, labels, nb_vals):
+    # Mean grid position (per parameter) of the cluster with the highest likelihood
+    counts = np.bincount(labels)
+    means = np.where(counts > 0, np.bincount(labels, weights=likelihood) / np.maximum(counts, 1), -np.inf)
+    return axis_indices(bpe, nb_vals)[labels == means.argmax()].mean(axis=0)
+
+def warm_start_likelihood(bpe, daily_data, module, policy, full=False):
+    ''' Likelihood of the search space using the previous-day likelihood of the policy (see warm_start_policy)
+    Output: likelihoods, True if all the combinations were evaluated
+    Combinations not evaluated get their previous-day likelihood, capped by the lowest likelihood evaluated today '''
+
+    previous = policy['previous']
+    n_combs = grid_size(bpe)
+    full = full or previous is None or len(previous) != n_combs or policy['days_since_full'] + 1 >= policy['full_every']
+
+    if full:
+        likelihood = get_likelihood_grid(bpe, daily_data, module['alpha_sc'], module['Adjust'])
+        policy['days_since_full'] = 0
+        policy['full_sweeps'] += 1
+        evaluated = n_combs
+    else:
+        # Plausible region of the previous day, dilated by a guard band of grid neighbours
+        region = np.zeros(policy['nb_vals'], dtype=bool)
+        grid_pos = tuple(axis_indices(bpe, policy['nb_vals']).T)
+        region[grid_pos] = previous >= np.quantile(previous, policy['quantile'])
+        if policy['guard'] > 0:
+            region = binary_dilation(region, structure=np.ones((3,)*len(policy['nb_vals']), dtype=bool), iterations=policy['guard'])
+        selected = region[grid_pos]
+
+        likelihood = previous.copy()
+        likelihood[selected] = get_likelihood_grid(grid_take(bpe, selected), daily_data, module['alpha_sc'], module['Adjust'])
+        likelihood[~selected] = np.minimum(previous[~selected], likelihood[selected].min())
+        policy['days_since_full'] += 1
+        evaluated = int(selected.sum())
+
+    policy['evaluated'] += evaluated
+    policy['previous'] = likelihood
+
+    return likelihood, full
+
+def evaluate_day(day, daily_data, bpe, module, num_clusters=5, seed=0, clusterer='exact', adaptive=None, warm_start=None):
+    ''' Inputs:
+    day: day to evaluate ('%Y-%m-%d')
+    daily_data: DataFrame of training data of the day (see get_daily_data)
+    bpe: search space (DataFrame or compact grid, see compact_grid), not modified
+    module: module specs (dictionary)
+    num_clusters, seed: K-means settings (seeded so that results are reproducible)
+    clusterer: 'exact' or 'sklearn' (see cluster_likelihood)
+    adaptive: settings of adaptive_search (dictionary with param_ranges, nb_vals, levels, keep) used instead of bpe
+    warm_start: state of the day-to-day warm start (see warm_start_policy), updated in place
+    Output: (conf_int, likelihoods, cluster labels) or None if the day does not have enough data '''
+
+    if len(daily_data) <= 10:
+        log_metrics('skipped_day', day=day, samples=len(daily_data))
+        return None
+    print(day)
 
-expected_vals = []
-for param in ['IL', 'Io', 'Rs', 'Rsh', 'a']:
-    expected_vals.append(cluster_means[param].mean())  # Используем средние значения кластеров
-expected_vals = pd.DataFrame([expected_vals], columns=['IL', 'Io', 'Rs', 'Rsh', 'a'])
-print('Expected Values')
-print(expected_vals)
+    with stage('likelihood', day=day, samples=len(daily_data)) as counts:
+        if adaptive is not None:
+            bpe = adaptive_search(daily_data=daily_data, module=module, **adaptive)
+            likelihood = bpe['Likelihood'].to_numpy()
+        elif warm_start is not None:
+            likelihood, full = warm_start_likelihood(bpe, daily_data, module, warm_start)
+        else:
+            likelihood = get_likelihood_grid(bpe, daily_data, module['alpha_sc'], module['Adjust'])
+        counts['combinations'] = len(likelihood)
+
+    with stage('clustering', day=day, combinations=len(likelihood)):
+        labels = cluster_likelihood(likelihood, num_clusters, clusterer, seed)
+
+    if warm_start is not None and adaptive is None:
+        # Abrupt change (e.g. a fault): the top cluster moved, evaluate the whole grid again
+        top_mean = _top_cluster_mean(bpe, likelihood, labels, warm_start['nb_vals'])
+        if not full and np.abs(top_mean - warm_start['top_mean']).max() > warm_start['shift_thresh']:
+            likelihood, full = warm_start_likelihood(bpe, daily_data, module, warm_start, full=True)
+            labels = cluster_likelihood(likelihood, num_clusters, clusterer, seed)
+            top_mean = _top_cluster_mean(bpe, likelihood, labels, warm_start['nb_vals'])
+        warm_start['top_mean'] = top_mean
+        warm_start['total'] += grid_size(bpe) #once per day: the evaluations of a re-sweep day include its partial pass
+
+    return cluster_conf_int(bpe, likelihood, labels, day), likelihood, labels
+
+def cluster_conf_int(bpe, likelihood, labels, day):
+    # Cluster means of the search space for one day, most likely cluster first (see conf_intervals_from_likelihoods)
+    return conf_intervals_from_likelihoods(bpe, np.asarray(likelihood)[np.newaxis], [day], np.asarray(labels)[np.newaxis])
+
+def conf_intervals_from_likelihoods(bpe, likelihoods, days, labels=None, num_clusters=5, clusterer='exact', seed=0):
+    ''' Cluster means of the search space for each day, in one pass over the combinations
+    Inputs:
+    bpe: search space (DataFrame or compact grid, see compact_grid)
+    likelihoods: array (n_days, n_combinations), e.g. rows of a likelihood store (see likelihood_store)
+    days: day of each row ('%Y-%m-%d')
+    labels: cluster labels of the likelihoods (same shape), None to cluster each day (num_clusters, clusterer, seed: see evaluate_day)
+    Output: conf_intervals DataFrame (columns Cluster, ss_columns, Likelihood; most likely cluster of each day first, index = day)
+    The days and the combinations are processed by chunks within memory_budget '''
+
+    n_combs = grid_size(bpe)
+    day_chunk = budget_rows(16*max(n_combs, 1), 0.25)
+    frames = []
+    for start in range(0, len(days), day_chunk):
+        block = np.asarray(likelihoods[start:start+day_chunk], dtype=np.float64)
+        if labels is None:
+            block_labels = np.stack([cluster_likelihood(row, num_clusters, clusterer, seed) for row in block])
+        else:
+            block_labels = np.asarray(labels[start:start+day_chunk])
+        n_days = len(block)
+        size = int(block_labels.max()) + 1 if block_labels.size else 0
+
+        # Sums and counts per (day, cluster): the labels of each day are offset by size
+        codes = (block_labels + size*np.arange(n_days)[:, np.newaxis]).astype(np.int64)
+        counts = np.bincount(codes.ravel(), minlength=n_days*size)
+        sums = np.zeros((n_days*size, len(ss_columns) + 1))
+        sums[:, -1] = np.bincount(codes.ravel(), weights=block.ravel(), minlength=n_days*size)
+        comb_chunk = budget_rows(8*(len(ss_columns) + 2*n_days), 0.25)
+        for comb_start in range(0, n_combs, comb_chunk):
+            values = grid_values(bpe, ss_columns, comb_start, comb_start+comb_chunk)
+            chunk_codes = codes[:, comb_start:comb_start+comb_chunk].ravel()
+            for j in range(len(ss_columns)):
+                sums[:, j] += np.bincount(chunk_codes, weights=np.tile(values[:, j], n_days), minlength=n_days*size)
+
+        # Means of the clusters present in each day, sorted by likelihood
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = (sums / counts[:, np.newaxis]).reshape(n_days, size, -1)
+        for i in range(n_days):
+            present = np.flatnonzero(counts[i*size:(i+1)*size] > 0)
+            order = present[np.argsort(-means[i, present, -1], kind='stable')]
+            frame = pd.DataFrame(means[i, order], columns=ss_columns + ['Likelihood'], index=[days[start+i]]*len(order))
+            frame.insert(0, 'Cluster', order)
+            frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=['Cluster'] + ss_columns + ['Likelihood'])
+    return pd.concat(frames)
+
+def likelihood_store(days, n_combs, path=None, previous=None):
+    ''' Preallocated array of the likelihoods of the search space for each day (float32, NaN until the day is evaluated)
+    Inputs:
+    days: days of the rows ('%Y-%m-%d')
+    n_combs: number of combinations of the search space
+    path: .npy file of the array, memory-mapped (written atomically, then updated in place), None to keep it in memory
+    previous: store whose rows are copied for the days it has (e.g. the store of a previous run)
+    Output: dictionary of days, rows (row of each day), array (n_days, n_combs) and path '''
+
+    days = list(days)
+    shape = (len(days), n_combs)
+    if path is None:
+        array = np.full(shape, np.nan, dtype=np.float32)
+    else:
+        array = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.float32, shape=shape)
+        chunk = budget_rows(4*max(n_combs, 1), 0.25)
+        for start in range(0, len(days), chunk):
+            array[start:start+chunk] = np.nan
+    rows = {day: i for i, day in enumerate(days)}
+
+    if previous is not None:
+        for day, i in previous['rows'].items():
+            if day in rows:
+                array[rows[day]] = previous['array'][i]
+    if path is not None:
+        array.flush()
+        os.replace(path + '.tmp', path)
+
+    return {'days': days, 'rows': rows, 'array': array, 'path': path}
+
+def _concat_summaries(parts):
+    # Posterior summaries of consecutive chunks of days merged (see posterior_summary)
+    return {key: value if key.startswith('range_') or key == 'quantile_levels' else np.concatenate([part[key] for part in parts])
+            for key, value in parts[0].items()}
+
+_shared_grid = {}
+
+def _attach_grid(specs, columns, ranges):
+    # Runs once per worker: map the arrays of the search space stored in shared memory (read-only, no copy)
+    arrays = []
+    for name, shape, dtype in specs:
+        shm = shared_memory.SharedMemory(name=name)
+        values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        values.flags.writeable = False
+        _shared_grid.setdefault('shm', []).append(shm)
+        arrays.append(values)
+    if ranges is None:
+        _shared_grid['bpe'] = pd.DataFrame(arrays[0], columns=columns, copy=False)
+    else:
+        _shared_grid['bpe'] = {'ranges': ranges, 'axes': arrays[0], 'mpp': arrays[1]}
+
+def _evaluate_shared_day(day, daily_data, module, num_clusters, seed, clusterer, adaptive):
+    return evaluate_day(day, daily_data, _shared_grid['bpe'], module, num_clusters, seed, clusterer, adaptive)
+
+def _collect_days(results, likelihoods):
+    # conf_int of the evaluated days, their likelihoods written to the store as the days are done (not kept in memory)
+    conf_ints, evaluated = [], []
+    for day, result in results:
+        if result is None:
+            continue
+        conf_ints.append(result[0])
+        evaluated.append(day)
+        if likelihoods is not None:
+            likelihoods['array'][likelihoods['rows'][day]] = result[1]
+    return conf_ints, evaluated
+
+def run_days(data, bpe, module, workers=1, num_clusters=5, seed=0, clusterer='exact', adaptive=None, warm_start=None, posterior=None,
+             likelihoods=None):
+    ''' Inputs:
+    data: DataFrame of production data (all days to evaluate)
+    bpe: search space (DataFrame or compact grid, see compact_grid), shared read-only with the workers and not modified
+    module: module specs (dictionary)
+    workers: number of worker processes (1 runs in the current process)
+    num_clusters, seed, clusterer, adaptive, warm_start: see evaluate_day
+    posterior: dictionary with the param_ranges of the search space, filled with the posterior summaries
+    of the evaluated days (see posterior_summary, 'days' key added), None to skip (not available with adaptive)
+    likelihoods: store filled with the likelihoods of the evaluated days (see likelihood_store), None to skip
+    (a temporary one is used for the posterior; not available with adaptive)
+    Output: conf_intervals DataFrame merged in date order (same as the serial run)
+    With warm_start, each day depends on the previous one: the days are evaluated in the current process '''
+
+    days = [day.strftime('%Y-%m-%d') for day in sorted(set(data.index.date))]
+    grid = bpe.drop(columns=['Likelihood', 'Cluster'], errors='ignore') if isinstance(bpe, pd.DataFrame) else bpe
+    if adaptive is not None:
+        likelihoods = None
+    elif likelihoods is None and posterior is not None:
+        likelihoods = likelihood_store(days, grid_size(grid))
+
+    # Training data of all the days, sampled in one call
+    with stage('get_daily_data', rows=len(data), days=len(days)) as counts:
+        train = get_daily_data(data, points_gpoa_bin=3, points_temp_bin=3, seed=seed)
+        counts['samples'] = len(train)
+    train = dict(list(train.groupby(train.index.strftime('%Y-%m-%d'))))
+    train = {day: train.get(day, data.iloc[:0]) for day in days}
+
+    if workers == 1 or warm_start is not None:
+        results = ((day, evaluate_day(day, train[day], grid, module, num_clusters, seed, clusterer, adaptive, warm_start)) for day in days)
+        conf_ints, evaluated = _collect_days(results, likelihoods)
+        if warm_start is not None:
+            print(f"warm start: {warm_start['evaluated']} of {warm_start['total']} evaluations "
+                  f"({warm_start['total'] - warm_start['evaluated']} saved), {warm_start['full_sweeps']} full sweeps")
+    else:
+        # The full grid as one float64 array, or the arrays of the compact grid
+        if isinstance(grid, pd.DataFrame):
+            arrays, columns, ranges = [grid.to_numpy(dtype=np.float64)], list(grid.columns), None
+        else:
+            arrays, columns, ranges = [np.asarray(grid['axes']), np.asarray(grid['mpp'])], None, grid['ranges']
+        blocks = [shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1)) for values in arrays]
+        try:
+            for shm, values in zip(blocks, arrays):
+                np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+            specs = [(shm.name, values.shape, values.dtype.str) for shm, values in zip(blocks, arrays)]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_grid, initargs=(specs, columns, ranges)) as pool:
+                futures = {day: pool.submit(_evaluate_shared_day, day, train[day], module, num_clusters, seed, clusterer, adaptive) for day in days}
+                conf_ints, evaluated = _collect_days(((day, futures.pop(day).result()) for day in days), likelihoods)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    if not evaluated:
+        return pd.DataFrame()
+
+    if posterior is not None and adaptive is None:
+        # From the store, by chunks of days within the memory budget
+        axes = axis_indices(grid, [len(values) for values in posterior['param_ranges']])
+        rows = [likelihoods['rows'][day] for day in evaluated]
+        chunk = budget_rows(4*max(grid_size(grid), 1), 0.25)
+        parts = [posterior_summary(likelihoods['array'][rows[start:start+chunk]], axes, posterior['param_ranges']) for start in range(0, len(rows), chunk)]
+        posterior.update(_concat_summaries(parts), days=np.array(evaluated))
+
+    conf_intervals = pd.concat(conf_ints)
+    conf_intervals.index = pd.to_datetime(conf_intervals.index)
+
+    return conf_intervals
+
+def grid_hash(bpe):
+    # Identity of the search space: results of a different grid cannot be reused (same hash for both forms of the grid)
+    digest = hashlib.sha256()
+    chunk = budget_rows(5*8, 0.25)
+    for start in range(0, grid_size(bpe), chunk):
+        digest.update(np.ascontiguousarray(grid_values(bpe, ['IL', 'Io', 'Rs', 'Rsh', 'a'], start, start+chunk)).tobytes())
+    return digest.hexdigest()[:16]
+
+def day_hashes(data):
+    # Fingerprint of the input data of each day, to detect new and changed days
+    codes = data.index.strftime('%Y-%m-%d')
+    rows = pd.util.hash_pandas_object(data, index=True).to_numpy()
+    return {day: hashlib.sha256(rows[codes == day].tobytes()).hexdigest()[:16] for day in sorted(set(codes))}
+
+def merge_posterior(saved, new, batch):
+    # Posterior summaries of saved with the days of batch replaced by the ones of new (see posterior_summary), sorted by day
+    new = {key: value for key, value in new.items() if key != 'param_ranges'} if 'days' in new else {}
+    if 'days' not in saved:
+        return new
+
+    keep = ~np.isin(saved['days'], batch)
+    merged = {}
+    for key, value in saved.items():
+        if key.startswith('range_') or key == 'quantile_levels': #same for all the days
+            merged[key] = value
+        else:
+            merged[key] = np.concatenate([value[keep], new[key]]) if new else value[keep]
+    order = np.argsort(merged['days'], kind='stable')
 
-expected_vals_iv = []
-for iv_prop in ['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']:
-    expected_vals_iv.append((bpe_iv[iv_prop].mean()))  # Используем средние значения кластеров
-expected_vals_iv = pd.DataFrame([expected_vals_iv], columns=['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc'])
-print('Expected Values')
-print(expected_vals_iv)
+    return {key: value if key.startswith('range_') or key == 'quantile_levels' else value[order] for key, value in merged.items()}
 
-#bpe.to_csv(f'{save_dir}/bpe_{
+def _save_manifest(manifest, manifest_path):
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
 
-# Сохранение файлов
-bpe.to_csv(f'{save_dir}/bpe_{pv_tech}.csv')
-conf_intervals.to_csv(f'{save_dir}/conf_intervals_{pv_tech}.csv')
-conf_intervals_iv.to_csv(f'{save_dir}/conf_intervals_iv_{pv_tech}.csv')
+def run_days_incremental(data, bpe, module, pv_tech, save_dir='results', workers=1, checkpoint_every=7, num_clusters=5, seed=0, clusterer='exact', adaptive=None, warm_start=None,
+                         param_ranges=None):
+    ''' Inputs:
+    data, bpe, module, workers, num_clusters, seed, clusterer, adaptive, warm_start: see run_days
+    pv_tech: technology (key of modules), used in the name of the output files
+    save_dir: directory of conf_intervals_{pv_tech}.csv and its manifest conf_intervals_{pv_tech}.json
+    checkpoint_every: number of days evaluated between two saves (an interrupted run resumes from the last save)
+    param_ranges: values of each parameter axis of bpe, the posterior summaries of each day are then saved
+    in posterior_{pv_tech}.npz (see posterior_summary), None to skip
+    Output: conf_intervals of all the days (previous results + new and changed days)
+    Only the days missing from the manifest, or whose data changed, are evaluated
+    Without adaptive, the likelihoods of each day are kept in likelihoods_{pv_tech}.npy (see likelihood_store), memory-mapped
+    and updated in place: one row per day of the manifest, the file is rewritten only when new days appear '''
+
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, f'conf_intervals_{pv_tech}.csv')
+    manifest_path = os.path.join(save_dir, f'conf_intervals_{pv_tech}.json')
+    posterior_path = os.path.join(save_dir, f'posterior_{pv_tech}.npz')
+    likelihoods_path = os.path.join(save_dir, f'likelihoods_{pv_tech}.npy')
+    save_posterior = param_ranges is not None and adaptive is None
+    save_likelihoods = adaptive is None
+
+    search = json.loads(json.dumps({'adaptive': adaptive, 'warm_start': warm_start and {key: warm_start[key] for key in ['quantile', 'guard', 'full_every', 'shift_thresh']}},
+                                   default=lambda value: np.asarray(value).tolist()))
+    manifest = {'grid': grid_hash(bpe), 'clusterer': clusterer, 'search': search, 'posterior': save_posterior, 'days': {}}
+    conf_intervals = pd.DataFrame()
+    posterior, store = {}, None
+    if os.path.exists(manifest_path) and os.path.exists(path) and (os.path.exists(posterior_path) or not save_posterior):
+        with open(manifest_path) as f:
+            saved = json.load(f)
+        if (saved['grid'], saved.get('clusterer'), saved.get('search'), saved.get('posterior', False)) == (manifest['grid'], clusterer, search, save_posterior): #otherwise the search space or the clusterer changed: evaluate everything again
+            manifest = saved
+            conf_intervals = pd.read_csv(path, index_col=0)
+            conf_intervals.index = pd.to_datetime(conf_intervals.index)
+            if save_posterior:
+                with np.load(posterior_path) as f:
+                    posterior = dict(f)
+            if save_likelihoods:
+                store = load_likelihoods(pv_tech, save_dir, mode='r+')
+
+    hashes = day_hashes(data)
+    todo = [day for day, day_hash in hashes.items() if manifest['days'].get(day) != day_hash]
+    print(f'{len(todo)} days to evaluate, {len(hashes) - len(todo)} up to date')
+
+    if save_likelihoods:
+        # One row per day of the manifest or of data (rows of the previous store copied to the new file)
+        days = sorted(set(manifest['days']) | set(hashes))
+        if store is None or store['days'] != days or store['array'].shape[1] != grid_size(bpe):
+            store = likelihood_store(days, grid_size(bpe), likelihoods_path, previous=store)
+            manifest['likelihood_days'] = days
+            if manifest['days']: #the saved results are still valid with the new file
+                _save_manifest(manifest, manifest_path)
+
+    day_codes = data.index.strftime('%Y-%m-%d')
+    new_conf_intervals, done = [], []
+    for start in range(0, len(todo), checkpoint_every):
+        batch = todo[start:start+checkpoint_every]
+        batch_posterior = {'param_ranges': param_ranges} if save_posterior else None
+        new_conf_intervals.append(run_days(data[day_codes.isin(batch)], bpe, module, workers=workers, num_clusters=num_clusters, seed=seed, clusterer=clusterer, adaptive=adaptive,
+                                           warm_start=warm_start, posterior=batch_posterior, likelihoods=store))
+        if save_posterior:
+            posterior = merge_posterior(posterior, batch_posterior, batch)
+        done += batch
+        manifest['days'].update({day: hashes[day] for day in batch}) #days without enough data are recorded too
+
+        # Previous results of the other days and the new ones, merged once per save
+        previous = conf_intervals[~conf_intervals.index.strftime('%Y-%m-%d').isin(done)] if len(conf_intervals) else conf_intervals
+        merged = pd.concat([previous] + new_conf_intervals).sort_index(kind='stable')
+
+        # Atomic save: results first, then the manifest that validates them
+        with stage('write', output=path, rows=len(merged)):
+            merged.to_csv(path + '.tmp')
+            os.replace(path + '.tmp', path)
+            if save_posterior:
+                with open(posterior_path + '.tmp', 'wb') as f:
+                    np.savez(f, **posterior)
+                os.replace(posterior_path + '.tmp', posterior_path)
+            if save_likelihoods:
+                store['array'].flush()
+            _save_manifest(manifest, manifest_path)
+
+    return merged if todo else conf_intervals
+
+def load_likelihoods(pv_tech, results_dir='results', mode='r'):
+    ''' Likelihoods of each day saved by run_days_incremental, memory-mapped (read-only by default, 'r+' to update them)
+    Output: store (see likelihood_store, rows of the days without enough data are NaN), None if not available (adaptive search) '''
+
+    path = os.path.join(results_dir, f'likelihoods_{pv_tech}.npy')
+    manifest_path = os.path.join(results_dir, f'conf_intervals_{pv_tech}.json')
+    if not os.path.exists(path) or not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        days = json.load(f).get('likelihood_days')
+    array = np.load(path, mmap_mode=mode)
+    if days is None or len(days) != len(array): #file of an interrupted run
+        return None
+
+    return {'days': days, 'rows': {day: i for i, day in enumerate(days)}, 'array': array, 'path': path}
+
+def run_tech(pv_tech, module, data=None, start=None, end=None, save_dir='results', nb_vals=[10]*5, freq=0.5, meas_unc=7.2,
+             workers=1, num_clusters=5, seed=0, clusterer='exact', adaptive=None, warm_start=None, store_dir=None):
+    ''' Full evaluation of one technology: SDM fit, search space and daily evaluation
+    Inputs:
+    pv_tech: name of the technology (used in the names of the output files)
+    module: module specs (dictionary)
+    data: cleaned data of the technology, read from the data store between start and end if None
+    nb_vals, freq, meas_unc: see search_space
+    workers, num_clusters, seed, clusterer: see run_days_incremental
+    adaptive: settings of adaptive_search (the param_ranges of the search space are used if not given)
+    warm_start: settings of warm_start_policy (dictionary, nb_vals excluded) or None
+    Output: dictionary of the updated module specs, bpe (with the likelihoods and clusters of the last evaluated day),
+    conf_intervals and conf_intervals_iv
+    The results are saved in save_dir as bpe_{pv_tech}.csv, conf_intervals_{pv_tech}.csv and conf_intervals_iv_{pv_tech}.csv,
+    and posterior_{pv_tech}.npz and likelihoods_{pv_tech}.npy without adaptive (see run_days_incremental)
+    The search space is kept in compact form during the evaluation (see compact_grid) '''
+
+    if data is None:
+        data = read_data_store(pv_tech, start, end, store_dir=store_dir)
+
+    fit_sdm(module)
+    param_ranges, grid = load_search_space(data, module, nb_vals=nb_vals, freq=freq, meas_unc=meas_unc, compact=True)
+    if adaptive is not None:
+        adaptive = dict({'param_ranges': param_ranges}, **adaptive)
+    if warm_start is not None:
+        warm_start = warm_start_policy(nb_vals, **warm_start)
+
+    conf_intervals = run_days_incremental(data, grid, module, pv_tech, save_dir=save_dir, workers=workers, num_clusters=num_clusters,
+                                          seed=seed, clusterer=clusterer, adaptive=adaptive, warm_start=warm_start, param_ranges=param_ranges)
+    conf_intervals_iv = pvsystem.singlediode(conf_intervals['IL'], conf_intervals['Io'], conf_intervals['Rs'], conf_intervals['Rsh'], conf_intervals['a'])
+    conf_intervals_iv = conf_intervals_iv[['p_mp', 'v_oc', 'i_sc', 'v_mp', 'i_mp']]
+
+    # Parameter values of the search space, with the likelihoods of the last evaluated day of the store
+    bpe = grid_frame(grid)
+    store = load_likelihoods(pv_tech, save_dir) if adaptive is None else None
+    for day in reversed(store['days'] if store else []):
+        likelihood = np.asarray(store['array'][store['rows'][day]], dtype=np.float64)
+        if not np.isnan(likelihood).all():
+            bpe['Likelihood'] = likelihood
+            bpe['Cluster'] = cluster_likelihood(likelihood, num_clusters, clusterer, seed)
+            break
+
+    with stage('write', output=save_dir, pv_tech=pv_tech, rows=len(bpe)):
+        os.makedirs(save_dir, exist_ok=True)
+        bpe.to_csv(f'{save_dir}/bpe_{pv_tech}.csv')
+        conf_intervals.to_csv(f'{save_dir}/conf_intervals_{pv_tech}.csv')
+        conf_intervals_iv.to_csv(f'{save_dir}/conf_intervals_iv_{pv_tech}.csv')
+
+    return {'module': module, 'bpe': bpe, 'conf_intervals': conf_intervals, 'conf_intervals_iv': conf_intervals_iv}
+
+def run_fleet(pv_techs, start=None, end=None, save_dir='results', workers=1, ingest=False, store_dir=None, **settings):
+    ''' Evaluation of several technologies in one job
+    Inputs:
+    pv_techs: list of technologies (keys of modules) or dictionary {pv_tech: module specs}
+    start, end: period to evaluate
+    workers: total number of worker processes, shared between the technologies and their daily evaluations
+    ingest: read the source files first (meteo data read once, see ingest_fleet), otherwise use the data store
+    settings: other arguments of run_tech (nb_vals, num_clusters, clusterer...)
+    Output: dictionary {pv_tech: results of run_tech}; the module specs in modules are updated '''
+
+    if not isinstance(pv_techs, dict):
+        pv_techs = {pv_tech: modules[pv_tech] for pv_tech in pv_techs}
+
+    fleet_data = {}
+    if ingest:
+        fleet_data = ingest_fleet(pv_source_paths(pv_techs, mirror_dir),
+                                  source_path(meteo_url, mirror_dir), start, end, store_dir)
+
+    tech_workers = max(1, min(len(pv_techs), workers))
+    day_workers = max(1, workers // tech_workers)
+    kwargs = {pv_tech: dict(settings, pv_tech=pv_tech, module=module, data=fleet_data.get(pv_tech), start=start, end=end,
+                            save_dir=save_dir, workers=day_workers, store_dir=store_dir) for pv_tech, module in pv_techs.items()}
+
+    if tech_workers == 1:
+        results = {pv_tech: run_tech(**kwargs[pv_tech]) for pv_tech in pv_techs}
+    else:
+        with ProcessPoolExecutor(max_workers=tech_workers) as pool:
+            futures = {pv_tech: pool.submit(run_tech, **kwargs[pv_tech]) for pv_tech in pv_techs}
+            results = {pv_tech: future.result() for pv_tech, future in futures.items()}
+
+    # Module specs completed by the workers (Adjust, P_mp_ref, pmp_min, pmp_max)
+    for pv_tech, module in pv_techs.items():
+        module.update(results[pv_tech]['module'])
+
+    return results
+
+"""###Streaming"""
+
+# Real-time mode: live PV and meteo records are cleaned online and the error sums of each grid combination are
+# accumulated as they arrive, so the likelihoods of the current day can be queried at any moment
+# Sources are async iterators of (kind, record): kind 'pv' or 'meteo', record = dictionary with Date and the measured values
+stream_columns = {'pv': ['Pmpp', 'Vmpp', 'Impp', 'Tmod'], 'meteo': ['GPOA']}
+
+async def tail_csv(path, kind, columns=None, rename=None, poll=1.0, follow=True):
+    ''' Source reading a CSV file as it is written (same format as the source files, with a 'Date' column)
+    Inputs:
+    kind: 'pv' or 'meteo'
+    columns, rename: columns to read and their new names (default: the columns of stream_columns)
+    poll: delay (s) between two reads at the end of the file
+    follow: wait for new lines at the end of the file, otherwise stop there '''
+
+    columns = columns or stream_columns[kind]
+    header, line = None, ''
+    with open(path) as f:
+        while True:
+            line += f.readline()
+            if not line.endswith('\n'): #end of the file (or line being written)
+                if follow:
+                    await asyncio.sleep(poll)
+                    continue
+                if not line:
+                    return
+            row, line = line.rstrip('\r\n').split(','), ''
+            if header is None:
+                header = row
+            elif len(row) == len(header):
+                values = dict(zip(header, row))
+                record = {(rename or {}).get(col, col): float(values[col]) for col in columns}
+                record['Date'] = pd.Timestamp(values['Date'])
+                yield kind, record
+            await asyncio.sleep(0) #let the other sources run
+
+async def socket_source(host='127.0.0.1', port=8765):
+    ''' Source receiving JSON lines {"kind": "pv" or "meteo", "Date": ..., values} from local clients (stand-in for the live feed)
+    Stops when a client sends {"kind": "end"} '''
+
+    queue = asyncio.Queue()
+
+    async def handle(reader, writer):
+        async for line in reader:
+            if line.strip():
+                queue.put_nowait(json.loads(line))
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    try:
+        while True:
+            record = await queue.get()
+            kind = record.pop('kind')
+            if kind == 'end':
+                return
+            record['Date'] = pd.Timestamp(record['Date'])
+            yield kind, record
+    finally:
+        server.close()
+        await server.wait_closed()
+
+def stream_state(bpe, module, num_clusters=5, clusterer='exact', seed=0, mit=100, sigma=5, out_thresh=0.05, lag=None,
+                 gpoa_interval=100, points_gpoa_bin=3, temp_interval=5, points_temp_bin=3, batch_size=16,
+                 ratio_window=None, n_sigma=2, min_ratio_samples=30, alert_drop=0.05, min_samples=20, baseline=None):
+    ''' State of the streaming evaluation (dictionary, updated by stream_push, stream_query and stream_close)
+    Inputs:
+    bpe: search space, DataFrame or compact grid (see load_search_space), module: module specs (with Adjust, see fit_sdm)
+    num_clusters, clusterer, seed: see cluster_likelihood
+    mit: minimum intensity threshold (W/m2), only GPOA above it is kept; Impp, Vmpp and Pmpp must be positive
+    sigma, out_thresh: Gaussian outlier check (see filter_outliers), applied to each 5 s stream on its own
+    lag: number of later samples the check of a sample waits for (bounded latency); the default (4*sigma) gives the
+    same result as filter_outliers, 0 uses the past samples only
+    gpoa_interval, points_gpoa_bin, temp_interval, points_temp_bin: online stratified sampling, the first points of
+    each irradiance or temperature bin of the day are used (same sample size as get_daily_data)
+    batch_size: samples evaluated at once on the grid (bounds the latency of stream_push and stream_query)
+    ratio_window, n_sigma: outliers of Impp/GPOA (see ratio_bounds), statistics of the previous ratio_window - 1 days and of the
+    samples of the day so far (Welford), checked once min_ratio_samples are available; None to skip
+    alert_drop: relative drop of the STC power of the most likely cluster w.r.t. the baseline triggering an alert
+    min_samples: samples of the day needed before an alert
+    baseline: STC power of reference (W), the last value of the previous day is used afterwards '''
+
+    radius = int(4*sigma + 0.5) #same truncation as gaussian_filter1d
+    kernel = np.exp(-0.5*(np.arange(-radius, radius + 1)/sigma)**2)
+
+    return {'bpe': bpe, 'module': module, 'num_clusters': num_clusters, 'clusterer': clusterer, 'seed': seed,
+            'lower_bounds': {'pv': {'Impp': 0, 'Vmpp': 0, 'Pmpp': 0}, 'meteo': {'GPOA': mit}},
+            'kernel': kernel/kernel.sum(), 'radius': radius, 'lag': radius if lag is None else min(lag, radius), 'out_thresh': out_thresh,
+            'bins': (gpoa_interval, points_gpoa_bin, temp_interval, points_temp_bin), 'batch_size': batch_size,
+            'ratio_window': ratio_window, 'n_sigma': n_sigma, 'min_ratio_samples': min_ratio_samples, 'ratio_days': [], 'ratio_today': [0, 0.0, 0.0],
+            'alert_drop': alert_drop, 'min_samples': min_samples, 'baseline': baseline, 'callbacks': {},
+            'streams': {kind: {'slot': None, 'sum': 0, 'count': 0, 'day': None, 'times': [], 'values': [], 'decided': 0} for kind in stream_columns},
+            'join': {}, 'latest': {}, 'day': None, 'last_sample': None, 'days': {}, 'conf_int': None, 'alerts': [],
+            'pending': [], 'samples': 0, 'ape_sum': np.zeros(grid_size(bpe)), 'se_sum': np.zeros(grid_size(bpe)), 'bin_counts': ({}, {})}
+
+def _stream_check(state, stream, ended=False):
+    # Gaussian outlier check of the samples of the day having lag later samples (all of them at the end of the day)
+    # Same window as gaussian_filter1d (reflected at the day boundaries), truncated to the samples received
+    values, n, kernel = stream['values'], len(stream['values']), state['kernel']
+    last = n if ended else n - state['lag']
+    kept = []
+    for i in range(stream['decided'], last):
+        idx = np.arange(i - state['radius'], i + state['radius'] + 1)
+        idx = np.where(idx < 0, -idx - 1, idx)
+        if ended:
+            weights, idx = kernel, np.where(idx >= n, 2*n - idx - 1, idx)
+        else:
+            weights, idx = kernel[idx < n], idx[idx < n]
+        smooth = weights @ np.array([values[j] for j in np.clip(idx, 0, n - 1)]) / weights.sum()
+        if (np.abs(smooth - values[i]) / (values[i] + 1E-8) <= state['out_thresh']).all():
+            kept.append((stream['times'][i], values[i]))
+    stream['decided'] = max(stream['decided'], last)
+    return kept
+
+def _stream_slot(state, kind, ended=False):
+    # Close the current 5 s slot of a stream (mean of its records, as slot_means) and check it
+    stream = state['streams'][kind]
+    kept = []
+    if stream['slot'] is not None:
+        if stream['day'] is not None and stream['slot'].normalize() != stream['day']: #the outlier check is done day by day
+            kept += _stream_check(state, stream, ended=True)
+            stream.update(times=[], values=[], decided=0)
+        stream['day'] = stream['slot'].normalize()
+        stream['times'].append(stream['slot'])
+        stream['values'].append(stream['sum'] / stream['count'])
+        stream['slot'] = None
+    kept += _stream_check(state, stream, ended)
+
+    for slot, values in kept:
+        state['join'].setdefault(slot, {})[kind] = values
+        state['latest'][kind] = slot
+    for slot in sorted(state['join']): #the slots are complete in time order
+        if len(state['join'][slot]) == len(stream_columns):
+            _stream_sample(state, slot, state['join'].pop(slot))
+        elif len(state['latest']) == len(stream_columns) and slot < min(state['latest'].values()):
+            del state['join'][slot] #missing in one of the streams (outlier or no record)
+
+def _stream_sample(state, slot, values):
+    # Merged PV and meteo sample: new day, online stratified sampling, evaluation on the grid by batches
+    if state['day'] is not None and slot.normalize() != state['day']:
+        _stream_end_day(state)
+    state['day'], state['last_sample'] = slot.normalize(), slot
+
+    pmpp, vmpp, impp, tmod = values['pv']
+    gpoa = values['meteo'][0]
+
+    if state['ratio_window'] is not None:
+        ratio, today = impp/gpoa, state['ratio_today']
+        today[0] += 1
+        delta = ratio - today[1]
+        today[1] += delta/today[0]
+        today[2] += delta*(ratio - today[1])
+        n, mean, m2 = combine_stats(*np.array(state['ratio_days'] + [today]).T)
+        if n >= state['min_ratio_samples'] and abs(ratio - mean) > state['n_sigma']*np.sqrt(m2/(n - 1)):
+            return
+    gpoa_interval, points_gpoa_bin, temp_interval, points_temp_bin = state['bins']
+    gpoa_counts, temp_counts = state['bin_counts']
+    gpoa_bin, temp_bin = np.floor(gpoa / gpoa_interval), np.floor(tmod / temp_interval)
+    open_bins = [(counts, b) for counts, b, points in [(gpoa_counts, gpoa_bin, points_gpoa_bin), (temp_counts, temp_bin, points_temp_bin)]
+                 if counts.get(b, 0) < points]
+    if not open_bins:
+        return
+    for counts, b in open_bins:
+        counts[b] = counts.get(b, 0) + 1
+
+    state['pending'].append([gpoa, tmod, impp, vmpp, pmpp])
+    if len(state['pending']) >= state['batch_size']:
+        _stream_flush(state)
+
+def _stream_flush(state):
+    # Add the error sums of the pending samples
+    if not state['pending']:
+        return
+    samples = pd.DataFrame(state['pending'], columns=['GPOA', 'Tmod', 'Impp', 'Vmpp', 'Pmpp'])
+    with stage('stream_flush', samples=len(samples), combinations=grid_size(state['bpe'])):
+        ape_sum, se_sum = likelihood_error_sums(state['bpe'], samples, state['module']['alpha_sc'], state['module']['Adjust'])
+    state['ape_sum'] += ape_sum
+    state['se_sum'] += se_sum
+    state['samples'] += len(samples)
+    state['pending'] = []
+
+def _stream_end_day(state):
+    # Final results of the day, used as the baseline of the next day
+    conf_int = stream_query(state)
+    if conf_int is not None:
+        state['days'][state['day'].strftime('%Y-%m-%d')] = conf_int
+        state['baseline'] = conf_int['p_mp'].iloc[0]
+        if 'day' in state['callbacks']:
+            state['callbacks']['day'](conf_int)
+    if state['ratio_window'] is not None and state['ratio_today'][0]: #previous ratio_window - 1 days
+        state['ratio_days'] = (state['ratio_days'] + [state['ratio_today']])[1 - state['ratio_window']:] if state['ratio_window'] > 1 else []
+    state.update(pending=[], samples=0, ape_sum=np.zeros(grid_size(state['bpe'])), se_sum=np.zeros(grid_size(state['bpe'])),
+                 bin_counts=({}, {}), conf_int=None, ratio_today=[0, 0.0, 0.0])
+
+def stream_push(state, kind, record):
+    ''' Add a live record (see the sources) to the streaming state: bounds, 5 s slots, outlier check and merge of the streams
+    The merged samples are evaluated on the grid by batches of state['batch_size'] '''
+
+    values = np.array([record.get(col, np.nan) for col in stream_columns[kind]], dtype=np.float64)
+    if np.isnan(values).any():
+        return
+    for col, bound in state['lower_bounds'][kind].items():
+        if not values[stream_columns[kind].index(col)] > bound:
+            return
+
+    stream = state['streams'][kind]
+    slot = pd.Timestamp(record['Date']).floor('5s')
+    if stream['slot'] is not None and slot != stream['slot']:
+        _stream_slot(state, kind)
+    if stream['slot'] is None:
+        stream.update(slot=slot, sum=0, count=0)
+    stream['sum'] = stream['sum'] + values
+    stream['count'] += 1
+
+def stream_query(state):
+    ''' Likelihoods of the current day from the samples received so far
+    Output: conf_int of the day (cluster means, same as evaluate_day) or None if the day does not have enough data
+    An alert is raised when the STC power of the most likely cluster dropped by more than alert_drop '''
+
+    _stream_flush(state)
+    if state['samples'] <= 10:
+        return None
+
+    day = state['day'].strftime('%Y-%m-%d')
+    with stage('stream_query', day=day, samples=state['samples'], combinations=grid_size(state['bpe'])):
+        likelihood = likelihood_from_sums(state['ape_sum'], state['se_sum'], state['samples'])
+        labels = cluster_likelihood(likelihood, state['num_clusters'], state['clusterer'], state['seed'])
+        conf_int = cluster_conf_int(state['bpe'], likelihood, labels, day)
+    state['conf_int'] = conf_int
+
+    p_mp, baseline = conf_int['p_mp'].iloc[0], state['baseline']
+    already = any(alert['day'] == day for alert in state['alerts'])
+    if baseline and not already and state['samples'] >= state['min_samples'] and (baseline - p_mp)/baseline > state['alert_drop']:
+        alert = {'day': day, 'time': str(state['last_sample']), 'p_mp': float(p_mp), 'baseline': float(baseline),
+                 'drop': float((baseline - p_mp)/baseline), 'samples': state['samples']}
+        state['alerts'].append(alert)
+        log_metrics('alert', **alert)
+        if 'alert' in state['callbacks']:
+            state['callbacks']['alert'](alert)
+
+    return conf_int
+
+def stream_close(state):
+    # End of the streams: last slots, outlier check of the end of the day, results of the last day
+    for kind in stream_columns:
+        _stream_slot(state, kind, ended=True)
+    if state['day'] is not None:
+        _stream_end_day(state)
+    return state
+
+async def run_stream(sources, bpe, module, query_every=60, on_query=None, on_day=None, on_alert=None, **settings):
+    ''' Streaming evaluation of one technology
+    Inputs:
+    sources: list of sources (e.g. tail_csv of the PV and meteo files, or socket_source)
+    bpe, module, settings: see stream_state
+    query_every: delay (s) between two queries of the current-day likelihoods (see stream_query)
+    on_query, on_day, on_alert: functions called with the conf_int of each query, the final conf_int of each day
+    and each alert (dictionary)
+    Output: state (see stream_state), with the results of each day in state['days'] and the alerts in state['alerts'] '''
+
+    state = stream_state(bpe, module, **settings)
+    state['callbacks'] = {key: func for key, func in [('day', on_day), ('alert', on_alert)] if func is not None}
+
+    async def consume(source):
+        async for kind, record in source:
+            stream_push(state, kind, record)
+
+    async def query():
+        while True:
+            await asyncio.sleep(query_every)
+            conf_int = stream_query(state)
+            if conf_int is not None and on_query is not None:
+                on_query(conf_int)
+
+    querier = asyncio.ensure_future(query())
+    try:
+        await asyncio.gather(*[consume(source) for source in sources])
+    finally:
+        querier.cancel()
+
+    return stream_close(state)
+
+"""###Benchmark"""
+
+def synthetic_data(module, days=7, start='2022-03-01', freq='5s', cloudy=0.5, outlier_rate=0.01, noise=0.005, params=None, seed=0):
+    ''' SIRTA-like synthetic PV and meteo series generated with known SDM parameters
+    Inputs:
+    module: module specs (dictionary)
+    days: number of days, starting at start
+    freq: sampling period of both series
+    cloudy: fraction of cloudy days (random attenuation of the irradiance), the others are clear-sky days
+    outlier_rate: fraction of PV points multiplied by a random factor (spikes and drops)
+    noise: relative measurement noise of the PV variables
+    params: true SDM parameters [IL, Io, Rs, Rsh, a] (reference parameters of fit_sdm if None)
+    Output: pv_data, meteo_data (as read from the source files, after the MIT) and the true parameters '''
+
+    rng = np.random.default_rng(seed)
+    if params is None:
+        params = list(fit_sdm(module)[:5])
+    IL, Io, Rs, Rsh, a = params
+
+    index = pd.date_range(start, periods=days*(pd.Timedelta('1D')//pd.Timedelta(freq)), freq=freq, name='Date')
+    hours = (index - index.floor('D')) / pd.Timedelta('1h')
+    day = (index.floor('D') - index[0].floor('D')).days.to_numpy()
+
+    # Clear-sky irradiance between 7h and 19h, attenuated by smooth random clouds on cloudy days
+    sun = np.clip(np.sin(np.pi*(hours.to_numpy() - 7)/12), 0, None)
+    gpoa = 1000*rng.uniform(0.8, 1.1, days)[day]*sun**1.2
+    clouds = gaussian_filter1d(rng.uniform(0.2, 1, len(index)), sigma=60)
+    clouds = (clouds - clouds.min()) / (clouds.max() - clouds.min() + 1E-12)*0.8 + 0.2
+    gpoa = np.where((rng.random(days) < cloudy)[day], gpoa*clouds, gpoa)
+    tmod = 5 + 10*rng.random(days)[day] + 0.03*gpoa
+
+    valid = gpoa > 0
+    IL_adj, Io_adj, _, Rsh_adj, a_adj = pvsystem.calcparams_cec(gpoa[valid], tmod[valid], alpha_sc=module['alpha_sc'],
+                                                                I_L_ref=IL, I_o_ref=Io, R_s=Rs, R_sh_ref=Rsh, a_ref=a,
+                                                                Adjust=fit_sdm(module)[5])
+    mpp = max_power_point_warm(IL_adj, Io_adj, 1000/gpoa[valid]*Rs, Rsh_adj, a_adj)
+
+    pv_data = pd.DataFrame({'Pmpp': mpp['p_mp'], 'Vmpp': mpp['v_mp'], 'Impp': mpp['i_mp'], 'Tmod': tmod[valid]}, index=index[valid])
+    pv_data[['Pmpp', 'Vmpp', 'Impp']] *= 1 + rng.normal(0, noise, (len(pv_data), 3))
+    outliers = rng.random(len(pv_data)) < outlier_rate
+    pv_data.loc[outliers, ['Pmpp', 'Impp']] *= rng.uniform(0.3, 1.7, (outliers.sum(), 1))
+
+    meteo_data = pd.DataFrame({'GPOA': gpoa[valid]}, index=pv_data.index)
+
+    # Same lower bounds as the ingest (positive values, MIT)
+    pv_data = pv_data[(pv_data[['Impp', 'Vmpp', 'Pmpp']] > 0).all(axis=1)].astype(np.float32)
+    meteo_data = meteo_data[meteo_data['GPOA'] > 100].astype(np.float32)
+
+    return pv_data, meteo_data, params
+
+def _package_version(name):
+    try:
+        return importlib.metadata.version(name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def _timed(timings, stage_name, func, *args, **kwargs):
+    # Run func and accumulate its wall time (s) in timings[stage_name]
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings[stage_name] = timings.get(stage_name, 0) + time.perf_counter() - start
+    return result
+
+def benchmark_pipeline(pv_tech='cSi', days=7, nb_vals=[5]*5, num_clusters=5, clusterer='exact', cloudy=0.5, outlier_rate=0.01,
+                       tol_steps={'IL': 2, 'Io': 2, 'Rs': 2, 'Rsh': 3, 'a': 2}, tol_pmp=0.02, seed=0):
+    ''' Time each stage of the pipeline on synthetic data (see synthetic_data) and check the recovery of the true parameters
+    Inputs:
+    pv_tech: technology (key of modules)
+    days, cloudy, outlier_rate: synthetic data settings
+    nb_vals, num_clusters, clusterer: evaluation settings
+    tol_steps: tolerance of the recovered parameters (mean of the top cluster of each day), in grid steps (Io in log scale)
+    tol_pmp: tolerance of the relative error of the MPP power simulated with the recovered parameters
+    Output: dictionary of settings, timings (s), counts, recovery and store (round trip of the clean data through the data store) '''
+
+    module = dict(modules[pv_tech])
+    max_power_point_warm(1, 1E-10, 0.1, 100, 1) #compile the numba path (if any) outside of the timings
+    pv_data, meteo_data, params = synthetic_data(module, days=days, cloudy=cloudy, outlier_rate=outlier_rate, seed=seed)
+    timings = {}
+
+    pv_data = _timed(timings, 'resample', slot_means, pv_data, '5s')
+    meteo_data = _timed(timings, 'resample', slot_means, meteo_data, '5s')
+    pv_data = _timed(timings, 'filter_outliers', filter_outliers, pv_data, sigma=5)
+    meteo_data = _timed(timings, 'filter_outliers', filter_outliers, meteo_data, sigma=5)
+
+    def clean():
+        data = align(pv_data, meteo_data)
+        return data[ratio_mask(data)]
+    data = _timed(timings, 'merge', clean)
+
+    # Data store written in two runs (the last day on its own, as the nightly ingest does), then read back whole
+    with tempfile.TemporaryDirectory() as store_dir:
+        last = data.index.normalize() == data.index.normalize().max()
+        for part in [data[~last], data[last]]:
+            if len(part):
+                _timed(timings, 'write_store', write_data_store, part, pv_tech, store_dir)
+        stored = _timed(timings, 'read_store', read_data_store, pv_tech, store_dir=store_dir)
+    store_ok = stored.index.equals(data.index) and np.array_equal(stored[data.columns].to_numpy(), data.to_numpy(), equal_nan=True)
+
+    param_ranges, bpe = _timed(timings, 'search_space', search_space, data, module, nb_vals=nb_vals)
+    train = _timed(timings, 'get_daily_data', get_daily_data, data, points_gpoa_bin=3, points_temp_bin=3, seed=seed)
+
+    conf_intervals, samples = [], []
+    for day, daily_data in train.groupby(train.index.strftime('%Y-%m-%d')):
+        samples.append(len(daily_data))
+        if len(daily_data) <= 10:
+            continue
+        likelihood = _timed(timings, 'get_likelihood', get_likelihood_grid, bpe, daily_data, module['alpha_sc'], module['Adjust'])
+        labels = _timed(timings, 'kmeans', cluster_likelihood, likelihood, num_clusters, clusterer, seed)
+        conf_intervals.append(_timed(timings, 'conf_int', cluster_conf_int, bpe, likelihood, labels, day))
+    conf_intervals = pd.concat(conf_intervals)
+
+    _timed(timings, 'singlediode', pvsystem.singlediode, conf_intervals['IL'], conf_intervals['Io'], conf_intervals['Rs'], conf_intervals['Rsh'], conf_intervals['a'])
+    _timed(timings, 'singlediode', pvsystem.singlediode, bpe['IL'], bpe['Io'], bpe['Rs'], bpe['Rsh'], bpe['a'])
+
+    # Recovery: distance (in grid steps) between the true parameters and the mean of the top cluster of each day
+    top = conf_intervals.groupby(level=0).head(1)[['IL', 'Io', 'Rs', 'Rsh', 'a']]
+    true, steps = np.array(params, dtype=float), np.array([np.ptp(r)/max(len(r) - 1, 1) for r in param_ranges])
+    top_log = top.to_numpy(dtype=float, copy=True)
+    top_log[:, 1], true[1] = np.log10(top_log[:, 1]), np.log10(true[1])
+    steps[1] = np.ptp(np.log10(param_ranges[1]))/max(len(param_ranges[1]) - 1, 1)
+    error_steps = np.abs(top_log - true).mean(axis=0)/np.where(steps > 0, steps, 1)
+    if not isinstance(tol_steps, dict):
+        tol_steps = dict.fromkeys(['IL', 'Io', 'Rs', 'Rsh', 'a'], tol_steps)
+
+    # Same check on the MPP power simulated over the clean data of each day (the science that must not change)
+    def p_mp(values, day_data):
+        IL_adj, Io_adj, _, Rsh_adj, a_adj = pvsystem.calcparams_cec(day_data['GPOA'], day_data['Tmod'], alpha_sc=module['alpha_sc'],
+                                                                    I_L_ref=values[0], I_o_ref=values[1], R_s=values[2],
+                                                                    R_sh_ref=values[3], a_ref=values[4], Adjust=module['Adjust'])
+        return max_power_point_warm(IL_adj, Io_adj, 1000/day_data['GPOA']*values[2], Rsh_adj, a_adj)['p_mp']
+    days_data = dict(list(data.groupby(data.index.strftime('%Y-%m-%d'))))
+    error_pmp = max(float(np.mean(np.abs(p_mp(values, days_data[day]) - p_mp(params, days_data[day]))/p_mp(params, days_data[day])))
+                    for day, values in zip(top.index, top.to_numpy(dtype=float)))
+
+    ok = all(error_steps[i] <= tol_steps[param] for i, param in enumerate(['IL', 'Io', 'Rs', 'Rsh', 'a'])) and error_pmp <= tol_pmp
+
+    return {'pv_tech': pv_tech, 'days': days, 'nb_vals': list(nb_vals), 'num_clusters': num_clusters, 'clusterer': clusterer,
+            'cloudy': cloudy, 'outlier_rate': outlier_rate, 'seed': seed,
+            'timings': timings,
+            'counts': {'rows': len(pv_data), 'rows_clean': len(data), 'grid': len(bpe), 'days_evaluated': top.index.nunique(),
+                       'samples_per_day': float(np.mean(samples)) if samples else 0.0},
+            'recovery': {'true': list(map(float, params)), 'error_steps': dict(zip(['IL', 'Io', 'Rs', 'Rsh', 'a'], map(float, error_steps))),
+                         'tol_steps': tol_steps, 'error_pmp': error_pmp, 'tol_pmp': tol_pmp, 'ok': ok},
+            'store': {'rows': len(stored), 'ok': store_ok}}
+
+def run_benchmarks(pv_techs=['cSi'], days_list=[3, 10], nb_vals_list=[[5]*5, [7]*5], path='results/benchmark.json', **kwargs):
+    ''' Sweep of benchmark_pipeline over the data length and the size of the grid
+    Inputs:
+    pv_techs, days_list, nb_vals_list: values of the sweep
+    path: JSON file of the results (with the versions of the environment), None to skip saving
+    kwargs: other arguments of benchmark_pipeline
+    Output: list of benchmark_pipeline results '''
+
+    results = []
+    for pv_tech in pv_techs:
+        for days in days_list:
+            for nb_vals in nb_vals_list:
+                result = benchmark_pipeline(pv_tech, days=days, nb_vals=nb_vals, **kwargs)
+                print(pv_tech, days, nb_vals, {stage: round(t, 3) for stage, t in result['timings'].items()}, 'recovery ok:', result['recovery']['ok'], 'store ok:', result['store']['ok'])
+                results.append(result)
+
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                                       'pvlib': pvlib.__version__, 'numba': _package_version('numba')},
+                       'results': results}, f, indent=1)
+
+    return results
+
+def compare_benchmarks(baseline_path, path, rtol=0.2, min_time=0.05):
+    ''' Compare two benchmark files (see run_benchmarks) run with the same sweep
+    rtol: relative slowdown of a stage reported as a regression
+    min_time: stages faster than this (s) in both runs are not reported (timer noise)
+    Output: DataFrame of the stage timings (baseline, new, ratio) and list of regressions (slower stages, lost recovery or data store round trip) '''
+
+    runs = []
+    for p in [baseline_path, path]:
+        with open(p) as f:
+            runs.append({(r['pv_tech'], r['days'], tuple(r['nb_vals'])): r for r in json.load(f)['results']})
+
+    rows, regressions = [], []
+    for key in runs[0].keys() & runs[1].keys():
+        old, new = runs[0][key], runs[1][key]
+        for stage in old['timings'].keys() & new['timings'].keys():
+            ratio = new['timings'][stage]/max(old['timings'][stage], 1E-9)
+            rows.append([*key, stage, old['timings'][stage], new['timings'][stage], ratio])
+            if ratio > 1 + rtol and max(old['timings'][stage], new['timings'][stage]) >= min_time:
+                regressions.append(f'{key} {stage}: {ratio:.2f}x slower')
+        if old['recovery']['ok'] and not new['recovery']['ok']:
+            regressions.append(f'{key}: true parameters no longer recovered')
+        if not new.get('store', {'ok': True})['ok']:
+            regressions.append(f'{key}: data store round trip lost or changed rows')
+
+    comparison = pd.DataFrame(rows, columns=['pv_tech', 'days', 'nb_vals', 'stage', 'baseline', 'new', 'ratio'])
+    return comparison.sort_values(['pv_tech', 'days', 'nb_vals', 'stage'], ignore_index=True), regressions
 
 """###Plots"""
 
-results_dir = 'results/'
-import os
+def load_results(pv_tech, results_dir='results'):
+    # Outputs of run_tech: bpe, conf_intervals and conf_intervals_iv
+    bpe = pd.read_csv(os.path.join(results_dir, f'bpe_{pv_tech}.csv'), index_col=0)
+    conf_intervals = pd.read_csv(os.path.join(results_dir, f'conf_intervals_{pv_tech}.csv'), index_col=0)
+    conf_intervals.index = pd.to_datetime(conf_intervals.index)
+    conf_intervals_iv = pd.read_csv(os.path.join(results_dir, f'conf_intervals_iv_{pv_tech}.csv'), index_col=0)
+    conf_intervals_iv.index = pd.to_datetime(conf_intervals_iv.index)
+    return bpe, conf_intervals, conf_intervals_iv
+
+def load_posterior(pv_tech, results_dir='results'):
+    # Posterior summaries of each day saved by run_tech (see posterior_summary), None if not available (adaptive search)
+    path = os.path.join(results_dir, f'posterior_{pv_tech}.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return dict(f)
+
+def expected_values(bpe, conf_intervals, conf_intervals_iv):
+    ''' Print the expected values for the module SDM parameters and IV properties, and the prediction precision of the last day
+    Output: expected_vals, expected_vals_iv, bpe_iv (IV properties of the search space) '''
+
+    days = sorted(set(conf_intervals.index))
+    cluster_means = conf_intervals.loc[days[-1]] #clusters of the last evaluated day
+
+    bpe_iv = pvsystem.singlediode(bpe['IL'], bpe['Io'], bpe['Rs'], bpe['Rsh'], bpe['a'])
+    if 'Cluster' in bpe: #likelihoods and clusters of the last evaluated day (not saved when no day was evaluated in the run)
+        bpe_iv['Likelihood'] = bpe['Likelihood']
+        bpe_iv['Cluster'] = bpe['Cluster']
+
+    expected_vals = []
+    for param in ['IL', 'Io', 'Rs', 'Rsh', 'a']:
+        expected_vals.append(cluster_means[param].mean())  # Используем средние значения кластеров
+    expected_vals = pd.DataFrame([expected_vals], columns=['IL', 'Io', 'Rs', 'Rsh', 'a'])
+    print('Expected Values')
+    print(expected_vals)
+
+    expected_vals_iv = []
+    for iv_prop in ['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']:
+        expected_vals_iv.append((bpe_iv[iv_prop].mean()))  # Используем средние значения кластеров
+    expected_vals_iv = pd.DataFrame([expected_vals_iv], columns=['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc'])
+    print('Expected Values')
+    print(expected_vals_iv)
+
+    # Prediction precision
+    for i, iv_prop in enumerate(['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']):
+        v_min, v_max = conf_intervals_iv.loc[days[-1], iv_prop].min(), conf_intervals_iv.loc[days[-1], iv_prop].max()
+        v_exp = expected_vals_iv.loc[0, iv_prop]
+        print(f'{iv_prop}: {np.round((v_min - v_exp) / v_exp * 100, 2)}% {np.round((v_max - v_exp) / v_exp * 100, 2)}%')
+
+    return expected_vals, expected_vals_iv, bpe_iv
 
-# Задаем путь к директории
-results_dir = 'results/'
-
-# Создаем директорию, если она не существует
-if not os.path.exists(results_dir):
-    os.makedirs(results_dir)
-
-import matplotlib.pyplot as plt
-import seaborn
-from pvlib import pvsystem
-
-pv_tech = 'cSi'
-
-bpe.to_csv(f'{save_dir}/bpe_{pv_tech}.csv')
-
-bpe = pd.read_csv(results_dir + f'bpe_{pv_tech}.csv', index_col=0)
-bpe_iv = pvsystem.singlediode(bpe['IL'], bpe['Io'], bpe['Rs'], bpe['Rsh'], bpe['a'])
-bpe_iv['Cluster'] = bpe['Cluster']
-
-conf_intervals = pd.read_csv(results_dir + f'conf_intervals_{pv_tech}.csv', index_col=0)
-conf_intervals.index = pd.to_datetime(conf_intervals.index)
-days = sorted(set(conf_intervals.index))
-
-#conf_intervals_iv = pd.read_csv(results_dir + f'conf_intervals_iv_{pv_tech}.csv', index_col=0)
-#conf_intervals_iv.index = pd.to_datetime(conf_intervals_iv.index)
-
-module = modules[pv_tech]
-module['P_mp_ref'] = module['V_mp_ref']*module['I_mp_ref']
-
-IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, module['Adjust'] = ivtools.sdm.fit_cec_sam(celltype=module['celltype'], v_mp=module['V_mp_ref'], i_mp=module['I_mp_ref'], v_oc=module['V_oc_ref'], i_sc=module['I_sc_ref'], alpha_sc=module['alpha_sc'], beta_voc=module['beta_oc'], gamma_pmp=module['gamma_pmp'], cells_in_series=module['cells_in_series'], temp_ref=module['temp_ref'])
-kB, q = 1.38 * 10**-23, 1.602 * 10**-19
-ref_values = [IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref]
-Vth = kB*(module['temp_ref']+273.15)/q
-
-data = pd.DataFrame(data=[[module['P_mp_ref'], 1000, 25]], columns=['Pmpp', 'GPOA', 'Tmod'])
-param_ranges, _ = search_space(data, module, nb_vals=[2]*5, freq=0.5, meas_unc=0)
-
-params = ['IL', 'Io', 'Rs', 'Rsh', 'a']
 param_labels = ['I$_L$', 'I$_o$', 'R$_s$', 'R$_{sh}$', 'a']
 param_units = ['A', 'A', 'Ω', 'Ω', 'unitless']
 param_scales = ['linear', 'log', 'linear', 'linear', 'linear']
-
 iv_props = ['P$_{MPP}$', 'V$_{MPP}$', 'I$_{MPP}$', 'V$_{oc}$', 'I$_{sc}$']
 iv_props_units = ['W', 'V', 'A', 'V', 'A']
 
-expected_vals = []
-for param in ['IL', 'Io', 'Rs', 'Rsh', 'a']:
-    expected_vals.append(cluster_means[param].mean())  # Используем средние значения кластеров
-expected_vals = pd.DataFrame([expected_vals], columns=['IL', 'Io', 'Rs', 'Rsh', 'a'])
-print('Expected Values')
-print(expected_vals)
-
-
-
-expected_vals_iv = []
-for iv_prop in ['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']:
-    expected_vals_iv.append((bpe_iv[iv_prop].mean()))  # Используем средние значения кластеров
-expected_vals_iv = pd.DataFrame([expected_vals_iv], columns=['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc'])
-print('Expected Values')
-print(expected_vals_iv)
-
-# Prediction precision
-for i, iv_prop in enumerate(['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']):
-    v_min, v_max = conf_intervals_iv.loc[days[-1], iv_prop].min(), conf_intervals_iv.loc[days[-1], iv_prop].max()
-    v_exp = expected_vals_iv.loc[0, iv_prop]
-    # print(f'{iv_prop}: {np.round(v_min - v_exp, 2)}{iv_props_units[i]} {np.round(v_max - v_exp, 2)}{iv_props_units[i]}')
-    print(f'{iv_prop}: {np.round((v_min - v_exp) / v_exp * 100, 2)}% {np.round((v_max - v_exp) / v_exp * 100, 2)}%')
-
-# IV properties Histogram
-# SDM Param Dist
-fig, ax = plt.subplots(1, 5, figsize=(10, 2.5), sharey=True, constrained_layout=True)
-ax[0].set_ylim([0, 1])
-ax[0].set_ylabel('Probability')
-
-for i, param in enumerate(params):
-    # Группируем данные
-    grouped_data = bpe.groupby(param).sum()
-
-    # Получаем значения для построения графиков
-    x_values = grouped_data.index
-    y_values = grouped_data['Cluster'].values
-
-    # Нормализация для получения вероятностей
-    total = y_values.sum()
-    probabilities = y_values / total
-
-    if param == 'a':
-        adjusted_x_values = x_values / Vth / module['cells_in_series']
-        ax[i].plot(adjusted_x_values, probabilities)  # Используем вероятности для графика
-        ax[i].set_xlabel(f'n [{param_units[i]}]')
-        n_ref = ref_values[i] / Vth / module['cells_in_series']
-        ax[i].plot([n_ref] * 2, [0, 1], '--')
-        ax[i].axvspan(param_ranges[i][0] / Vth / module['cells_in_series'], param_ranges[i][1] / Vth / module['cells_in_series'], alpha=0.15, color='orange')
-
-    else:
-        ax[i].plot(x_values, probabilities)  # Используем вероятности для графика
-        ax[i].set_xlabel(f'{param_labels[i]} [{param_units[i]}]')
-        ax[i].plot([ref_values[i]] * 2, [0, 1], '--')
-        ax[i].axvspan(param_ranges[i][0], param_ranges[i][1], alpha=0.15, color='orange')
-
-    # Вывод значений вероятностей
-    for j in range(len(probabilities)):
-        print(f'{param_labels[i]} [{param_units[i]}]: Value = {x_values[j]:.4f}, Probability = {probabilities[j]:.4f}')
-
-    ax[i].set_xscale(param_scales[i])
-
-fig.suptitle('Values at STC')
-plt.show()
-
-# Confidence Intervals
-fig, ax = plt.subplots(5, sharex=True, figsize=(10, 10), constrained_layout=True)
-for i, iv_prop in enumerate(['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']):
-    seaborn.boxplot(x=conf_intervals_iv.loc[days[::2]].index.date, y=conf_intervals_iv.loc[days[::2], iv_prop],
-                    showfliers=True, ax=ax[i],
-                    showmeans=False, meanline=False,
-                    flierprops=dict(marker='o', markersize=3))
-    ax[i].set_ylabel(f'{iv_props[i]} [{iv_props_units[i]}]')
-
-plt.xticks(rotation=45)
-fig.suptitle('90% Confidence Interval (Values at STC)')
-plt.locator_params(axis='x', nbins=9)
-
-fig, ax = plt.subplots(5, sharex=True, figsize=(10, 10), constrained_layout=True)
-for i, iv_prop in enumerate(params):
-    seaborn.boxplot(x=conf_intervals.loc[days[::2]].index.date, y=conf_intervals.loc[days[::2], iv_prop],
-                    showfliers=True, ax=ax[i],
-                    showmeans=False, meanline=False,
-                    flierprops=dict(marker='o', markersize=3))
-    ax[i].set_ylabel(f'{param_labels[i]} [{param_units[i]}]')
-    ax[i].set_yscale(param_scales[i])
-
-plt.xticks(rotation=45)
-fig.suptitle('90% Confidence Interval (Values at STC)')
-plt.locator_params(axis='x', nbins=9)
-
-import pandas as pd
-import matplotlib.pyplot as plt
-
-# Пример данных
-# bpe_iv - ваш DataFrame с данными
-# Замените на ваши данные
-bpe_iv = pd.DataFrame({
-    'Cluster': ['A', 'A', 'B', 'B', 'C'],
-    'p_mp': [0.1, 0.3, 0.2, 0.4, 0.3],
-    'v_mp': [1.0, 1.2, 1.1, 1.3, 1.2],
-    'i_mp': [5, 4, 6, 5, 7],
-    'v_oc': [10, 10.5, 10.2, 10.3, 10.4],
-    'i_sc': [15, 14, 15, 16, 14],
-})
-
-iv_props = ['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']
-iv_props_units = ['V', 'V', 'A', 'V', 'A']
-
-# IV properties Histogram
-fig, ax = plt.subplots(1, 5, figsize=(13, 2.5), sharey=True, constrained_layout=True)
-
-# Словарь для хранения вероятностей
-probabilities = {}
-
-for i, iv_prop in enumerate(iv_props):
-    # Группируем данные по кластерам для IV свойств
-    cluster_data = bpe_iv.groupby('Cluster')[iv_prop].sum()
-
-    # Рассчитываем вероятности
-    total = cluster_data.sum()
-    prob = cluster_data / total
-
-    # Сохраняем значения вероятностей
-    probabilities[iv_prop] = prob
+def plot_param_distribution(pv_tech, posterior, day=-1):
+    # Marginal posterior of the SDM parameters at STC on one day (see posterior_summary), reference values and range of the search space
+    import matplotlib.pyplot as plt
 
-    # Строим гистограмму для каждого IV свойства
-    ax[i].bar(cluster_data.index, prob, alpha=0.6)
-
-    ax[i].set_xlabel(f'{iv_prop} [{iv_props_units[i]}]')
-
-ax[0].set_ylim([0, 1])
-ax[0].set_ylabel('Probability')
-fig.suptitle('IV Properties Distribution at STC')
+    module = modules[pv_tech]
+    module['P_mp_ref'] = module['V_mp_ref']*module['I_mp_ref']
 
-plt.show()
+    IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref, module['Adjust'] = fit_sdm(module)
+    kB, q = 1.38 * 10**-23, 1.602 * 10**-19
+    ref_values = [IL_ref, Io_ref, Rs_ref, Rsh_ref, a_ref]
+    Vth = kB*(module['temp_ref']+273.15)/q
 
-# Печатаем значения вероятностей
-for iv_prop, prob in probabilities.items():
-    print(f'Пробabilities for {iv_prop}:')
-    print(prob)
+    data = pd.DataFrame(data=[[module['P_mp_ref'], 1000, 25]], columns=['Pmpp', 'GPOA', 'Tmod'])
+    param_ranges, _ = search_space(data, module, nb_vals=[2]*5, freq=0.5, meas_unc=0)
 
-import time
+    # SDM Param Dist
+    fig, ax = plt.subplots(1, 5, figsize=(10, 2.5), sharey=True, constrained_layout=True)
+    ax[0].set_ylim([0, 1])
+    ax[0].set_ylabel('Probability')
 
-# Продолжительность в секундах (2 часа)
-duration = 2 * 60 * 60
+    for i, param in enumerate(['IL', 'Io', 'Rs', 'Rsh', 'a']):
+        x_values = posterior[f'range_{param}']
+        probabilities = posterior[f'marginal_{param}'][day]
 
-# Начало таймера
-start_time = time.time()
+        if param == 'a':
+            adjusted_x_values = x_values / Vth / module['cells_in_series']
+            ax[i].plot(adjusted_x_values, probabilities)  # Используем вероятности для графика
+            ax[i].set_xlabel(f'n [{param_units[i]}]')
+            n_ref = ref_values[i] / Vth / module['cells_in_series']
+            ax[i].plot([n_ref] * 2, [0, 1], '--')
+            ax[i].axvspan(param_ranges[i][0] / Vth / module['cells_in_series'], param_ranges[i][1] / Vth / module['cells_in_series'], alpha=0.15, color='orange')
 
-while (time.time() - start_time) < duration:
-    # Ваш код здесь (например, просто ждем)
-    time.sleep(60)  # Ждем 1 минуту между итерациями
-    print("Сессия активна, прошло времени (в секундах):", time.time() - start_time)
-
-print("Хотя время закончилось, сессия может быть отключена.")
\ No newline at end of file
+        else:
+            ax[i].plot(x_values, probabilities)  # Используем вероятности для графика
+            ax[i].set_xlabel(f'{param_labels[i]} [{param_units[i]}]')
+            ax[i].plot([ref_values[i]] * 2, [0, 1], '--')
+            ax[i].axvspan(param_ranges[i][0], param_ranges[i][1], alpha=0.15, color='orange')
+
+        # Вывод значений вероятностей
+        for j in range(len(probabilities)):
+            print(f'{param_labels[i]} [{param_units[i]}]: Value = {x_values[j]:.4f}, Probability = {probabilities[j]:.4f}')
+
+        ax[i].set_xscale(param_scales[i])
+
+    fig.suptitle(f"Values at STC ({posterior['days'][day]})")
+
+    return fig
+
+def plot_joint_marginal(posterior, params=('Rs', 'Rsh'), day=-1):
+    # Joint posterior of two SDM parameters on one day (see posterior_summary)
+    import matplotlib.pyplot as plt
+
+    p, q = params
+    i, j = ['IL', 'Io', 'Rs', 'Rsh', 'a'].index(p), ['IL', 'Io', 'Rs', 'Rsh', 'a'].index(q)
+    fig, ax = plt.subplots(constrained_layout=True)
+    mesh = ax.pcolormesh(posterior[f'range_{q}'], posterior[f'range_{p}'], posterior[f'joint_{p}_{q}'][day], shading='nearest')
+    plt.colorbar(mesh, label='Probability')
+    ax.set_xlabel(f'{param_labels[j]} [{param_units[j]}]')
+    ax.set_ylabel(f'{param_labels[i]} [{param_units[i]}]')
+    ax.set_xscale(param_scales[j])
+    ax.set_yscale(param_scales[i])
+    fig.suptitle(f"Joint Distribution at STC ({posterior['days'][day]})")
+
+    return fig
+
+def plot_daily_boxplots(conf_intervals, columns, labels, units, scales=None, every=2):
+    ''' Boxplots of the cluster means of every 'every' days on a date axis (one box per day, cost independent of the samples)
+    Inputs:
+    conf_intervals: conf_intervals or conf_intervals_iv (see run_tech)
+    columns, labels, units, scales: variables to plot (one subplot each) '''
+
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    days = sorted(set(conf_intervals.index))[::every]
+    grouped = conf_intervals.loc[days].groupby(level=0)
+    positions = mdates.date2num([day for day, _ in grouped])
+
+    fig, ax = plt.subplots(len(columns), sharex=True, figsize=(10, 10), constrained_layout=True)
+    for i, col in enumerate(columns):
+        ax[i].boxplot([group[col].to_numpy() for _, group in grouped], positions=positions, widths=0.6*every,
+                      manage_ticks=False, flierprops=dict(marker='o', markersize=3))
+        ax[i].set_ylabel(f'{labels[i]} [{units[i]}]')
+        if scales is not None:
+            ax[i].set_yscale(scales[i])
+
+    ax[-1].xaxis_date()
+    ax[-1].tick_params(axis='x', labelrotation=45)
+    fig.suptitle('90% Confidence Interval (Values at STC)')
+
+    return fig
+
+def plot_iv_distribution(bpe_iv, bins=30):
+    # Posterior distribution of the IV properties at STC: histogram of the search space weighted by the normalized likelihood of the last evaluated day
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1, 5, figsize=(13, 2.5), sharey=True, constrained_layout=True)
+
+    likelihood = bpe_iv['Likelihood'].to_numpy(dtype=np.float64)
+    valid = np.isfinite(likelihood)
+    weights = likelihood[valid] / likelihood[valid].sum()
+
+    for i, iv_prop in enumerate(['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc']):
+        values = bpe_iv[iv_prop].to_numpy(dtype=np.float64)[valid]
+        ax[i].hist(values, bins=bins, weights=weights, alpha=0.6)
+        ax[i].set_xlabel(f'{iv_props[i]} [{iv_props_units[i]}]')
+
+    ax[0].set_ylim([0, 1])
+    ax[0].set_ylabel('Probability')
+    fig.suptitle('IV Properties Distribution at STC')
+
+    return fig
+
+def report_tasks(pv_tech, conf_intervals, conf_intervals_iv, bpe_iv, posterior=None):
+    ''' Figures of the report of one technology (see render_figures)
+    Inputs:
+    conf_intervals, conf_intervals_iv: outputs of run_tech (see load_results)
+    bpe_iv: IV properties of the search space (see expected_values)
+    posterior: posterior summaries of each day (see load_posterior), distributions of the last day plotted if given
+    Output: dictionary {name: (plot function, args, kwargs)} '''
+
+    tasks = {f'conf_intervals_iv_{pv_tech}': (plot_daily_boxplots, (conf_intervals_iv, ['p_mp', 'v_mp', 'i_mp', 'v_oc', 'i_sc'], iv_props, iv_props_units), {}),
+             f'conf_intervals_{pv_tech}': (plot_daily_boxplots, (conf_intervals, ['IL', 'Io', 'Rs', 'Rsh', 'a'], param_labels, param_units, param_scales), {})}
+    if 'Likelihood' in bpe_iv:
+        tasks[f'iv_distribution_{pv_tech}'] = (plot_iv_distribution, (bpe_iv,), {})
+    if posterior is not None:
+        tasks[f'param_distribution_{pv_tech}'] = (plot_param_distribution, (pv_tech, posterior), {})
+        tasks[f'joint_distribution_{pv_tech}'] = (plot_joint_marginal, (posterior,), {})
+
+    return tasks
+
+def report(pv_tech, results_dir='results', show=False, formats=('png',), workers=1, data=False, store_dir=None):
+    ''' Expected values and plots of the results of one technology
+    Inputs:
+    pv_tech: technology (key of modules)
+    results_dir: directory of the outputs of run_tech, where the figures are saved
+    show: display the figures (interactive sessions) instead of saving them
+    formats, workers: see render_figures
+    data: plot the cleaned data of the technology as well (read from the data store)
+    Output: dictionary of figures if show, otherwise list of the saved files '''
+
+    bpe, conf_intervals, conf_intervals_iv = load_results(pv_tech, results_dir)
+    _, _, bpe_iv = expected_values(bpe, conf_intervals, conf_intervals_iv)
+    tasks = report_tasks(pv_tech, conf_intervals, conf_intervals_iv, bpe_iv, load_posterior(pv_tech, results_dir))
+    if data:
+        days = conf_intervals.index.strftime('%Y-%m-%d')
+        data = read_data_store(pv_tech, days.min(), days.max(), store_dir=store_dir)
+        tasks[f'data_{pv_tech}'] = (plot_data, (data,), {})
+
+    if show:
+        import matplotlib.pyplot as plt
+        figs = {name: func(*args, **kwargs) for name, (func, args, kwargs) in tasks.items()}
+        plt.show()
+        return figs
+
+    return render_figures(tasks, results_dir, formats, workers=workers)
+
+"""###CLI"""
+
+def _nb_vals(values):
+    # One value: same number of values for the 5 parameters
+    return values * 5 if len(values) == 1 else values
+
+def main(argv=None):
+    ''' Command line interface, one subcommand per stage of the pipeline
+    clean: read, clean and store the PV and meteo data
+    search-space: build (or load from the cache) the search space of each technology
+    evaluate: daily evaluation of the technologies (results saved in --save-dir)
+    stream: real-time evaluation of live records (files followed as they are written, or a local socket)
+    report: expected values and plots of the results
+    benchmark: timings of the stages on synthetic data '''
+
+    global memory_budget
+
+    parser = argparse.ArgumentParser(description='Bayesian parameter estimation of the SDM of PV modules')
+    parser.add_argument('--metrics', help='JSON-lines file of the stage metrics (disabled if not given)')
+    parser.add_argument('--profile', help='stage to profile (e.g. search_space, likelihood)')
+    parser.add_argument('--profiler', default='cProfile', choices=['cProfile', 'pyinstrument'])
+    parser.add_argument('--store-dir', default=data_store_dir, help='data store directory')
+    parser.add_argument('--memory-budget', type=float, default=memory_budget, help='memory (MB) of the large temporaries (sets the chunk sizes)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_period(sub):
+        sub.add_argument('--techs', nargs='+', default=list(pv_urls), choices=list(modules))
+        sub.add_argument('--start', default='2022')
+        sub.add_argument('--end', default='2022-03-31')
+
+    sub = subparsers.add_parser('clean', help='read, clean and store the data')
+    add_period(sub)
+    sub.add_argument('--mirror-dir', default=mirror_dir, help='local copy of the source files')
+    sub.add_argument('--plot-dir', help='directory of the plots of the outliers and of the cleaned data')
+    sub.add_argument('--tolerance', default='0s', help='max time difference between a PV sample and the nearest meteo sample')
+    sub.add_argument('--window', help='average the meteo samples within this window around each PV sample instead (e.g. 30s)')
+    sub.add_argument('--ratio-window', type=int, help='days of the Impp/GPOA statistics of the 2 sigma filter (default: whole period)')
+
+    sub = subparsers.add_parser('search-space', help='build the search space')
+    add_period(sub)
+    sub.add_argument('--nb-vals', nargs='+', type=int, default=[10])
+    sub.add_argument('--meas-unc', type=float, default=7.2)
+
+    sub = subparsers.add_parser('evaluate', help='daily evaluation')
+    add_period(sub)
+    sub.add_argument('--nb-vals', nargs='+', type=int, default=[10])
+    sub.add_argument('--meas-unc', type=float, default=7.2)
+    sub.add_argument('--save-dir', default='results')
+    sub.add_argument('--workers', type=int, default=1)
+    sub.add_argument('--num-clusters', type=int, default=5)
+    sub.add_argument('--clusterer', default='exact', choices=['exact', 'sklearn'])
+    sub.add_argument('--seed', type=int, default=0)
+    sub.add_argument('--ingest', action='store_true', help='read the source files first instead of the data store')
+
+    sub = subparsers.add_parser('stream', help='real-time evaluation of live records')
+    sub.add_argument('--tech', default='cSi', choices=list(modules))
+    sub.add_argument('--start', default='2022', help='period of the stored data used to build the search space')
+    sub.add_argument('--end', default='2022-03-31')
+    sub.add_argument('--nb-vals', nargs='+', type=int, default=[10])
+    sub.add_argument('--meas-unc', type=float, default=7.2)
+    sub.add_argument('--pv', help='PV data file to follow')
+    sub.add_argument('--meteo', help='meteo data file to follow')
+    sub.add_argument('--socket', help='HOST:PORT receiving JSON lines instead of the files')
+    sub.add_argument('--no-follow', action='store_true', help='stop at the end of the files (replay)')
+    sub.add_argument('--query-every', type=float, default=60, help='delay (s) between two queries')
+    sub.add_argument('--alert-drop', type=float, default=0.05)
+    sub.add_argument('--baseline', type=float, help='STC power of reference (W)')
+    sub.add_argument('--lag', type=int, help='samples the outlier check waits for (default: same result as the batch check)')
+    sub.add_argument('--ratio-window', type=int, help='days of the Impp/GPOA statistics of the 2 sigma filter (none if not given)')
+    sub.add_argument('--save-dir', default='results')
+
+    sub = subparsers.add_parser('report', help='expected values and plots')
+    sub.add_argument('--techs', nargs='+', default=list(pv_urls), choices=list(modules))
+    sub.add_argument('--results-dir', default='results')
+    sub.add_argument('--show', action='store_true')
+    sub.add_argument('--formats', nargs='+', default=['png'], help='file formats of the figures (e.g. png svg)')
+    sub.add_argument('--workers', type=int, default=1, help='number of processes rendering the figures')
+    sub.add_argument('--data', action='store_true', help='plot the cleaned data as well')
+
+    sub = subparsers.add_parser('benchmark', help='timings on synthetic data')
+    sub.add_argument('--techs', nargs='+', default=['cSi'], choices=list(modules))
+    sub.add_argument('--days', nargs='+', type=int, default=[3, 10])
+    sub.add_argument('--nb-vals', nargs='+', type=int, default=[5, 7], help='grid sizes of the sweep (same for the 5 parameters)')
+    sub.add_argument('--output', default='results/benchmark.json')
+
+    args = parser.parse_args(argv)
+    memory_budget = args.memory_budget
+
+    if args.metrics:
+        enable_metrics(args.metrics, profile=args.profile, profiler=args.profiler)
+
+    if args.command == 'clean':
+        ingest_fleet(pv_source_paths(args.techs, args.mirror_dir),
+                     source_path(meteo_url, args.mirror_dir), args.start, args.end, args.store_dir, args.plot_dir,
+                     tolerance=args.tolerance, window=args.window, ratio_window=args.ratio_window)
+
+    elif args.command == 'search-space':
+        for pv_tech in args.techs:
+            data = read_data_store(pv_tech, args.start, args.end, store_dir=args.store_dir)
+            fit_sdm(modules[pv_tech])
+            param_ranges, bpe = load_search_space(data, modules[pv_tech], nb_vals=_nb_vals(args.nb_vals), meas_unc=args.meas_unc)
+            print(pv_tech, len(bpe), 'combinations')
+            print(pd.DataFrame([[values.min(), values.max(), len(values)] for values in param_ranges],
+                               index=['IL', 'Io', 'Rs', 'Rsh', 'a'], columns=['min', 'max', 'nb_vals']))
+
+    elif args.command == 'evaluate':
+        run_fleet(args.techs, args.start, args.end, save_dir=args.save_dir, workers=args.workers, ingest=args.ingest,
+                  store_dir=args.store_dir, nb_vals=_nb_vals(args.nb_vals), meas_unc=args.meas_unc,
+                  num_clusters=args.num_clusters, clusterer=args.clusterer, seed=args.seed)
+
+    elif args.command == 'stream':
+        module = modules[args.tech]
+        data = read_data_store(args.tech, args.start, args.end, store_dir=args.store_dir)
+        fit_sdm(module)
+        _, bpe = load_search_space(data, module, nb_vals=_nb_vals(args.nb_vals), meas_unc=args.meas_unc)
+        if args.socket:
+            host, port = args.socket.rsplit(':', 1)
+            sources = [socket_source(host, int(port))]
+        else:
+            sources = [tail_csv(args.pv, 'pv', follow=not args.no_follow),
+                       tail_csv(args.meteo, 'meteo', ['GPOA_pyrano'], rename={'GPOA_pyrano': 'GPOA'}, follow=not args.no_follow)]
+
+        os.makedirs(args.save_dir, exist_ok=True)
+        path = os.path.join(args.save_dir, f'stream_conf_intervals_{args.tech}.csv')
+        on_query = lambda conf_int: print(conf_int.index[0], 'P_mp (STC) of the most likely cluster:', round(conf_int['p_mp'].iloc[0], 2), 'W')
+        on_day = lambda conf_int: conf_int.to_csv(path, mode='a', header=not os.path.exists(path))
+        on_alert = lambda alert: print('ALERT', alert)
+        asyncio.run(run_stream(sources, bpe, module, query_every=args.query_every, on_query=on_query, on_day=on_day, on_alert=on_alert,
+                               num_clusters=5, alert_drop=args.alert_drop, baseline=args.baseline, lag=args.lag,
+                               ratio_window=args.ratio_window))
+
+    elif args.command == 'report':
+        for pv_tech in args.techs:
+            report(pv_tech, args.results_dir, show=args.show, formats=args.formats, workers=args.workers, data=args.data,
+                   store_dir=args.store_dir)
+
+    elif args.command == 'benchmark':
+        run_benchmarks(args.techs, days_list=args.days, nb_vals_list=[[n]*5 for n in args.nb_vals], path=args.output)
+
+    if args.metrics:
+        metrics_summary()
+
+if __name__ == '__main__':
+    main()